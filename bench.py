@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""Benchmarks of the pandacount pipeline on synthetic ING statements.
+
+The generated CSV files look like ING exports: header preamble, ISO-8859-1 encoding, German
+decimals and parties and purposes drawn from rules.yaml. Every stage runs against a scratch
+database, and the timings are appended to a results database so that runs can be compared.
+Each size runs in its own process, so that its peak memory does not include earlier sizes.
+"""
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from pathlib import Path
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+
+import duckdb
+import pandas as pd
+import typer
+
+import panda
+
+app = typer.Typer()
+
+
+# One statement per account is generated, see get_account in panda.py
+ACCOUNT_IBANS = {
+    "giro": "DE69500105175402313946",
+    "common": "DE97500105175409854125",
+    "gesa": "DE27500105175404412327",
+}
+
+ING_COLUMNS = [
+    "Buchung",
+    "Wertstellungsdatum",
+    "Auftraggeber/Empfänger",
+    "Buchungstext",
+    "Verwendungszweck",
+    "Saldo",
+    "Währung",
+    "Betrag",
+    "Währung",
+]
+
+BOOK_TEXTS = ["Lastschrift", "Gutschrift", "Ueberweisung", "Gehalt/Rente", "Wertpapierkauf"]
+
+# Bound of the generated balances. balance_cents is an INTEGER column, so the balance must stay
+# well within 32 bits for any number of rows.
+MAX_BALANCE_CENTS = 100_000_000
+
+# Parties and purposes that no rule matches
+UNMATCHED_PARTIES = ["VISA KIOSK AM PLATZ", "Müller Bäckerei", "Hausverwaltung Schulz; GbR"]
+UNMATCHED_PURPOSES = ["Rechnung", "NR XXXX 1234 BERLIN KAUFUMSATZ", 'Abo "Premium"']
+
+
+def german_decimal(cents: int) -> str:
+    """Formats cents like the ING export, e.g. -1.234,56."""
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100:,}".replace(",", ".") + f",{abs(cents) % 100:02d}"
+
+
+def csv_field(value: str) -> str:
+    """Quotes a field of the semicolon separated export if necessary."""
+    if ";" in value or '"' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def write_statement(path: Path, n_rows: int, iban: str, seed: int = 0):
+    """Writes an ING CSV export with n_rows transactions, newest first.
+
+    About two thirds of the parties and purposes are substrings of rules, so that the rule
+    engine does realistic work. The rows are written in chunks, so that statements with
+    millions of rows do not need to fit into memory.
+    """
+    rng = random.Random(seed)
+    rules = panda.rule_list(panda.load_rules()["category"])
+    parties = [sub for _, attribute, _, sub in rules if attribute == "party"]
+    purposes = [sub for _, attribute, _, sub in rules if attribute == "purpose"]
+
+    last_date = date(2025, 12, 31)
+    first_date = last_date - timedelta(days=max(n_rows // 10, 1))
+    balance = 1_000_000
+    preamble = [
+        f"Umsatzanzeige;Datei erstellt am: {last_date:%d.%m.%Y} 10:00",
+        "",
+        f"IBAN;{iban}",
+        "Kontoname;Girokonto",
+        "Bank;ING",
+        "Kunde;Max Mustermann",
+        f"Zeitraum;{first_date:%d.%m.%Y} - {last_date:%d.%m.%Y}",
+        f"Saldo;{german_decimal(balance)};EUR",
+        "",
+        "Sortierung;Datum absteigend",
+        "",
+        "In der CSV-Datei finden Sie alle bereits gebuchten Umsätze.",
+        "",
+        ";".join(ING_COLUMNS),
+    ]
+
+    with open(path, "w", encoding="iso-8859-1", errors="replace", newline="\n") as f:
+        f.write("\n".join(preamble) + "\n")
+        for chunk_start in range(0, n_rows, 100_000):
+            lines = []
+            for i in range(chunk_start, min(chunk_start + 100_000, n_rows)):
+                book_date = last_date - timedelta(days=i * (last_date - first_date).days // n_rows)
+                valuta_date = book_date - timedelta(days=rng.choice([0, 0, 0, 1, 2]))
+                amount = rng.choice([-1, -1, -1, 1]) * rng.randint(1, 250_000)
+                # Reflect the walk at the bounds, so that the balance never drifts away
+                if abs(balance - amount) > MAX_BALANCE_CENTS:
+                    amount = -amount
+                party = rng.choice(parties if rng.random() < 0.66 else UNMATCHED_PARTIES)
+                purpose = rng.choice(purposes if rng.random() < 0.66 else UNMATCHED_PURPOSES)
+                fields = [
+                    f"{book_date:%d.%m.%Y}",
+                    f"{valuta_date:%d.%m.%Y}",
+                    csv_field(party),
+                    rng.choice(BOOK_TEXTS),
+                    csv_field(f"{purpose} {rng.randrange(10**9):09d}"),
+                    german_decimal(balance),
+                    "EUR",
+                    german_decimal(amount),
+                    "EUR",
+                ]
+                lines.append(";".join(fields) + "\n")
+                balance -= amount
+            f.writelines(lines)
+
+
+def generate_statements(directory: Path, n_rows: int, seed: int = 0) -> list[str]:
+    """Writes n_rows transactions spread over one statement per account of ACCOUNT_IBANS."""
+    file_names = []
+    for i, (account, iban) in enumerate(ACCOUNT_IBANS.items()):
+        account_rows = n_rows // len(ACCOUNT_IBANS) + (i < n_rows % len(ACCOUNT_IBANS))
+        path = directory / f"Umsatzanzeige_{iban}_{date.today():%Y%m%d}.csv"
+        write_statement(path, account_rows, iban, seed=seed + i)
+        file_names.append(str(path))
+    return file_names
+
+
+@contextmanager
+def measure(results: list[dict], stage: str, n_rows: int):
+    """Records wall time, CPU time and peak memory of the enclosed stage, see profile_stage.
+
+    peak_mb is the peak resident set size of the benchmark process after the stage, or of a
+    parse worker process if that was larger. It never decreases between the stages of a size.
+    """
+    with panda.profile_stage(stage, n_rows) as record:
+        yield
+    results.append(
+        {
+            "n_rows": n_rows,
+            "stage": stage,
+            "seconds": record["seconds"],
+            "cpu_seconds": record["cpu_seconds"],
+            "peak_mb": max(record["peak_rss_mb"], panda.peak_rss_mb(resource.RUSAGE_CHILDREN)),
+        }
+    )
+
+
+def benchmark(n_rows: int, seed: int = 0) -> list[dict]:
+    """Runs the pipeline stages on n_rows synthetic transactions in a scratch directory."""
+    panda.PROFILE_STAGES = True
+    results: list[dict] = []
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = generate_statements(Path(directory), n_rows, seed)
+        os.environ["PANDACOUNT_DB"] = str(Path(directory) / "pandacount.duckdb")
+        try:
+            with measure(results, "parse", n_rows):
+                df = panda.parse_files(file_names)
+            with measure(results, "categorize", n_rows):
+                df = panda.categorize_pipeline(df)
+            with measure(results, "save", n_rows):
+                panda.save_pc_to_db(df)
+            with measure(results, "load", n_rows):
+                panda.load_pc_from_db(cents=True)
+            with measure(results, "load_compact", n_rows):
+                panda.load_pc_from_db(cents=True, compact=True)
+            con = duckdb.connect(os.environ["PANDACOUNT_DB"])
+            try:
+                with measure(results, "categorize_db", n_rows):
+                    panda.categorize_db(con, full=True)
+            finally:
+                con.close()
+        finally:
+            del os.environ["PANDACOUNT_DB"]
+    return results
+
+
+def git_commit() -> str | None:
+    """Returns the abbreviated hash of the checked out commit, if any."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results_path: Path, results: pd.DataFrame) -> pd.DataFrame:
+    """Appends results to the results database and returns them with the previous run."""
+    con = duckdb.connect(str(results_path))
+    try:
+        con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bench_results (
+                run_at TIMESTAMP NOT NULL,
+                git_commit TEXT,
+                n_rows BIGINT NOT NULL,
+                stage TEXT NOT NULL,
+                seconds DOUBLE NOT NULL,
+                cpu_seconds DOUBLE NOT NULL,
+                peak_mb DOUBLE NOT NULL
+            )
+        """
+        )
+        previous = con.execute(
+            """
+            SELECT n_rows, stage, seconds AS previous_seconds
+            FROM bench_results
+            QUALIFY run_at = max(run_at) OVER (PARTITION BY n_rows, stage)
+            """
+        ).df()
+        con.execute("INSERT INTO bench_results BY NAME SELECT * FROM results")
+    finally:
+        con.close()
+
+    results = results.merge(previous, on=["n_rows", "stage"], how="left")
+    results["change"] = results["seconds"] / results["previous_seconds"] - 1
+    return results
+
+
+@app.command()
+def generate(directory: str, rows: int = 10_000, seed: int = 0):
+    """Write synthetic ING statements with ROWS transactions in total to DIRECTORY."""
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for file_name in generate_statements(Path(directory), rows, seed):
+        print(f"Wrote {file_name}")
+
+
+@app.command(hidden=True)
+def stages(rows: int, output: str, seed: int = 0):
+    """Benchmark ROWS rows in this process and write the stage results as JSON to OUTPUT."""
+    Path(output).write_text(json.dumps(benchmark(rows, seed)))
+
+
+def benchmark_in_subprocess(n_rows: int, seed: int = 0) -> list[dict]:
+    """Runs benchmark in a new process, so that its peak memory only covers n_rows."""
+    with tempfile.TemporaryDirectory() as directory:
+        output = Path(directory) / "results.json"
+        subprocess.run(
+            [sys.executable, __file__, "stages", str(n_rows), str(output), "--seed", str(seed)],
+            check=True,
+        )
+        return json.loads(output.read_text())
+
+
+@app.command()
+def run(
+    sizes: list[int] = typer.Option([1_000, 10_000, 100_000], "--size"),
+    seed: int = 0,
+    results: str = "bench.duckdb",
+):
+    """Benchmark the pipeline stages for each --size and store the timings in RESULTS."""
+    run_at = datetime.now()
+    rows = []
+    for n_rows in sizes:
+        print(f"Benchmarking {n_rows} rows...")
+        rows.extend(benchmark_in_subprocess(n_rows, seed))
+
+    df = pd.DataFrame(rows)
+    df.insert(0, "run_at", run_at)
+    df.insert(1, "git_commit", git_commit())
+    df = save_results(Path(results), df)
+
+    df["change"] = df["change"].map(lambda change: "" if pd.isna(change) else f"{change:+.0%}")
+    print()
+    print(
+        df[["n_rows", "stage", "seconds", "cpu_seconds", "peak_mb", "change"]].to_string(
+            index=False, float_format="{:.3f}".format
+        )
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""Dash dashboard of expenses and income, served by ./panda.py serve.
+
+The callbacks run aggregating queries in DuckDB on read-only connections (see
+reader_connection in panda.py). They read the monthly sums of monthly_rollup, so a request
+aggregates a few hundred rows instead of the transactions. Query results are memoized per
+data version, which changes whenever a command writes the database.
+"""
+from datetime import date
+from functools import lru_cache
+
+from dash import Dash, Input, Output, dash_table, dcc, html
+import pandas as pd
+import plotly.express as px
+
+import panda
+
+# Number of query results kept in memory, see cached_query
+CACHE_SIZE = 256
+
+# Categories that are no expenses, like in the expense overview of panda_analysis.py
+NON_EXPENSE_PREFIXES = ["intern", "einnahmen"]
+INCOME_PREFIX = "einnahmen"
+
+# Category filters are nested set lookups in the categories table, see category_subtree_sql
+EXPENSE_SQL = (
+    "NOT transfer AND NOT COALESCE("
+    f"cat_id IN ({panda.category_subtree_sql(NON_EXPENSE_PREFIXES)}), false)"
+)
+INCOME_SQL = f"cat_id IN ({panda.category_subtree_sql([INCOME_PREFIX])})"
+
+cached_version: tuple[int, ...] | None = None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def cached_query(version: tuple[int, ...], sql: str, params: tuple) -> pd.DataFrame:
+    """Runs sql on a read-only connection, see query."""
+    with panda.db_connection(reader=True) as con:
+        return con.execute(sql, list(params)).df()
+
+
+def query(sql: str, params: tuple = ()) -> pd.DataFrame:
+    """Runs an aggregating query, memoized until the data changes.
+
+    The returned dataframe is shared between requests and must not be modified.
+    """
+    global cached_version
+    version = panda.data_version()
+    if version != cached_version:
+        cached_query.cache_clear()
+        cached_version = version
+    return cached_query(version, sql, params)
+
+
+def filter_sql(year: int, accounts: list[str], category_prefix: str | None) -> tuple[str, tuple]:
+    """Returns the WHERE conditions and parameters of the selected slice."""
+    conditions = ["month >= ?", "month < ?"]
+    params: list = [date(year, 1, 1), date(year + 1, 1, 1)]
+    conditions.append(f"account IN ({', '.join('?' for _ in accounts)})" if accounts else "false")
+    params.extend(accounts)
+    if category_prefix:
+        conditions.append(f"cat_id IN ({panda.category_subtree_sql([category_prefix])})")
+    return " AND ".join(conditions), tuple(params)
+
+
+def expense_rows(year: int, accounts: list[str], category_prefix: str | None) -> pd.DataFrame:
+    """Expenses in cents per category and account, without transfers and non-expenses."""
+    where, params = filter_sql(year, accounts, category_prefix)
+    return query(
+        f"""
+        SELECT COALESCE(cat, 'Uncategorized') AS cat, account, sum(amount_cents) AS amount_cents
+        FROM monthly_rollup
+        WHERE {where} AND {EXPENSE_SQL}
+        GROUP BY ALL
+        """,
+        params,
+    )
+
+
+def income_rows(year: int, accounts: list[str], category_prefix: str | None) -> pd.DataFrame:
+    """Income in cents per category."""
+    where, params = filter_sql(year, accounts, category_prefix)
+    return query(
+        f"""
+        SELECT cat, sum(amount_cents) AS amount_cents
+        FROM monthly_rollup
+        WHERE {where} AND {INCOME_SQL}
+        GROUP BY ALL
+        ORDER BY cat
+        """,
+        params,
+    )
+
+
+def monthly_expense_rows(
+    year: int, accounts: list[str], category_prefix: str | None
+) -> pd.DataFrame:
+    """Expenses in cents per month and top level category."""
+    where, params = filter_sql(year, accounts, category_prefix)
+    return query(
+        f"""
+        SELECT
+            month,
+            COALESCE(top.path, 'Uncategorized') AS top_category,
+            sum(amount_cents) AS amount_cents
+        FROM monthly_rollup
+        LEFT JOIN categories AS c ON c.category_id = cat_id
+        LEFT JOIN categories AS top ON top.category_id = c.level1_id
+        WHERE {where} AND {EXPENSE_SQL}
+        GROUP BY ALL
+        ORDER BY month, top_category
+        """,
+        params,
+    )
+
+
+def expense_overview(rows: pd.DataFrame) -> pd.DataFrame:
+    """Pivots expense_rows like generate_expense_overview in panda_analysis.py."""
+    if rows.empty:
+        return pd.DataFrame({"cat": ["Overall Sum"], "category_sum": [0.0]})
+    overview = rows.pivot_table(
+        index="cat", columns="account", values="amount_cents", aggfunc="sum", fill_value=0
+    )
+    overview.insert(0, "category_sum", overview.sum(axis=1))
+    overview.loc["Overall Sum"] = overview.sum()
+    return (overview / 100).rename_axis(index="cat", columns=None).reset_index()
+
+
+def income_overview(rows: pd.DataFrame) -> pd.DataFrame:
+    """Income per category with the overall sum, like generate_income_overview."""
+    overview = pd.DataFrame({"cat": rows["cat"], "category_sum": rows["amount_cents"] / 100})
+    overview.loc[len(overview)] = ["Overall Sum", rows["amount_cents"].sum() / 100]
+    return overview
+
+
+def table_data(df: pd.DataFrame) -> tuple[list[dict], list[dict]]:
+    """Returns the data and columns arguments of a DataTable."""
+    columns = [
+        (
+            {"name": c, "id": c, "type": "numeric", "format": {"specifier": ",.2f"}}
+            if c != "cat"
+            else {"name": c, "id": c}
+        )
+        for c in df.columns
+    ]
+    return df.to_dict("records"), columns
+
+
+def layout() -> html.Div:
+    """Builds the page with the filter options of the current data."""
+    years = query("SELECT DISTINCT year(month) AS year FROM monthly_rollup ORDER BY year DESC")
+    accounts = query("SELECT DISTINCT account FROM monthly_rollup ORDER BY account")
+    # All categories in tree order, so any subtree can be selected
+    prefixes = query("SELECT path AS prefix FROM categories ORDER BY lft")
+    year_options = [int(year) for year in years["year"]]
+    return html.Div(
+        [
+            html.H1("pandacount"),
+            html.Div(
+                [
+                    dcc.Dropdown(
+                        year_options,
+                        year_options[0] if year_options else None,
+                        id="year",
+                        clearable=False,
+                    ),
+                    dcc.Checklist(
+                        list(accounts["account"]),
+                        list(accounts["account"]),
+                        id="accounts",
+                        inline=True,
+                    ),
+                    dcc.Dropdown(
+                        list(prefixes["prefix"]), None, id="category", placeholder="Category"
+                    ),
+                ]
+            ),
+            dcc.Graph(id="monthly"),
+            html.H2("Expenses"),
+            dash_table.DataTable(id="expenses", sort_action="native"),
+            html.H2("Income"),
+            dash_table.DataTable(id="income", sort_action="native"),
+        ]
+    )
+
+
+def create_app() -> Dash:
+    """Creates the dashboard app; the layout is built anew on every page load."""
+    app = Dash(__name__, title="pandacount")
+    app.layout = layout
+
+    @app.callback(
+        Output("expenses", "data"),
+        Output("expenses", "columns"),
+        Output("income", "data"),
+        Output("income", "columns"),
+        Output("monthly", "figure"),
+        Input("year", "value"),
+        Input("accounts", "value"),
+        Input("category", "value"),
+    )
+    def update(year: int | None, accounts: list[str], category_prefix: str | None):
+        if year is None:
+            year = date.today().year
+        expenses = expense_overview(expense_rows(year, accounts, category_prefix))
+        income = income_overview(income_rows(year, accounts, category_prefix))
+        monthly = monthly_expense_rows(year, accounts, category_prefix)
+        figure = px.bar(
+            monthly.assign(amount=monthly["amount_cents"] / 100),
+            x="month",
+            y="amount",
+            color="top_category",
+            title=f"Expenses {year}",
+        )
+        return *table_data(expenses), *table_data(income), figure
+
+    return app
+
+
+if __name__ == "__main__":
+    create_app().run(debug=True)
@@ -1,31 +1,101 @@
 #!/usr/bin/env python
+from collections import deque
+from contextlib import contextmanager
+from datetime import date, datetime
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache, partial
 from pathlib import Path
-from typing import Callable
 import hashlib
+import json
+import mmap
+import os
+import pickle
+import resource
+import signal
+import sys
+import time
 
 import duckdb
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 import typer
-from toolz import pipe
-
+import yaml
 
-from contextlib import contextmanager
 
 app = typer.Typer()
 
+# Set by the --profile options, see main
+PROFILE_STAGES = False
+PROFILE_OUTPUT: Path | None = None
+# Whether writing commands publish a snapshot for readers, see publish_snapshot
+PUBLISH_SNAPSHOT = True
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """Returns the peak resident set size of this process so far, in MB.
+
+    Unlike tracemalloc, this includes the memory of DuckDB and Arrow. With
+    resource.RUSAGE_CHILDREN, it is the peak of the largest finished child process instead.
+    ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
 
 @contextmanager
-def skip_lines_until(file_name: str, predicate: Callable[[str], bool]):
-    """Skips lines until the predicate is true.
-    Then yields the file _including_ the line where the predicate is true."""
-    with open(file_name, mode="r", encoding="iso-8859-1") as f:
-        pos = f.tell()
-        while not predicate(f.readline()):
-            pos = f.tell()
-        # Go back to the beginning of the line
-        f.seek(pos)
-        yield f
+def profile_stage(name: str, n_rows: int | None = None):
+    """Reports wall time, CPU time and memory of the enclosed stage with --profile.
+
+    Yields a dict in which the stage can set n_rows once it is known. Memory is the peak
+    resident set size of the process (see peak_rss_mb) and how much the stage raised it. The
+    peak is never reset, so nested stages do not disturb each other, but a stage that stays
+    below an earlier peak shows no growth. Parse worker processes are not included.
+    """
+    record: dict = {"stage": name, "n_rows": n_rows}
+    if not PROFILE_STAGES:
+        yield record
+        return
+
+    start_peak = peak_rss_mb()
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        record["cpu_seconds"] = time.process_time() - start_cpu
+        record["peak_rss_mb"] = peak_rss_mb()
+        record["rss_growth_mb"] = record["peak_rss_mb"] - start_peak
+
+        rows = "" if record["n_rows"] is None else f", {record['n_rows']} rows"
+        typer.echo(
+            f"[profile] {name}: {record['seconds']:.3f}s wall, {record['cpu_seconds']:.3f}s CPU,"
+            f" {record['peak_rss_mb']:.1f} MB peak RSS (+{record['rss_growth_mb']:.1f} MB){rows}",
+            err=True,
+        )
+        if PROFILE_OUTPUT is not None:
+            with open(PROFILE_OUTPUT, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"at": datetime.now().isoformat(), **record}) + "\n")
+
+
+ING_HEADER = b"Buchung;Wertstellungsdatum;Auftraggeber"
+
+# File names of downloaded ING statements, Umsatzanzeige_<IBAN>_<date>.csv
+STATEMENT_GLOB = "Umsatzanzeige_*_*.csv"
+
+
+def count_lines_before(file_name: str, header: bytes) -> int:
+    """Returns the number of lines before the first line starting with header.
+
+    The file is memory-mapped and searched as bytes, so it is never decoded or read line by
+    line in Python."""
+    with open(file_name, mode="rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m[: len(header)] == header:
+            return 0
+        offset = m.find(b"\n" + header)
+        if offset == -1:
+            raise ValueError(f"No matching line found in {file_name}")
+        return m[: offset + 1].count(b"\n")
 
 
 def get_account(file_name: str) -> str:
@@ -42,485 +112,398 @@ def get_account(file_name: str) -> str:
     return iban_account_map[iban]
 
 
+def german_decimal_to_cents_sql(column: str) -> str:
+    """Returns a DuckDB expression parsing a German decimal like '-1.234,56' into cents.
+
+    The value is parsed as an exact DECIMAL, so no float rounding is involved."""
+    return (
+        f"CAST(CAST(replace(replace({column}, '.', ''), ',', '.') AS DECIMAL(18, 2)) * 100"
+        " AS BIGINT)"
+    )
+
+
+def amount_cents(df: pd.DataFrame) -> pd.Series:
+    """Returns the amounts of df in cents, also for dataframes that only have amount."""
+    if "amount_cents" in df.columns:
+        return df["amount_cents"]
+    return (df["amount"] * 100).round().astype("Int64")
+
+
+def add_amounts(df: pd.DataFrame) -> pd.DataFrame:
+    """Adds decimal amount and balance columns computed from the cents, e.g. for display."""
+    for column in ("amount", "balance"):
+        if f"{column}_cents" in df.columns:
+            df[column] = df[f"{column}_cents"] / 100.0
+    return df
+
+
 def to_raw_df(file_name: str) -> pd.DataFrame:
-    with skip_lines_until(
-        file_name, lambda line: line.startswith("Buchung;Wertstellungsdatum;Auftraggeber")
-    ) as f:
-        raw_df = pd.read_csv(f, sep=";", encoding="iso-8859-1")
-        raw_df.rename(
-            columns={
-                "Währung.1": "currency1",
-                "Währung": "currency",
-                "Auftraggeber/Empfänger": "party",
-                "Buchungstext": "book_text",
-                "Verwendungszweck": "purpose",
-            },
-            inplace=True,
-        )
-        raw_df["book_date"] = pd.to_datetime(raw_df["Buchung"], dayfirst=True)
-        raw_df["valuta_date"] = pd.to_datetime(raw_df["Wertstellungsdatum"], dayfirst=True)
-        raw_df["amount"] = pd.to_numeric(
-            raw_df["Betrag"].str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
-        )
-        raw_df["balance"] = pd.to_numeric(
-            raw_df["Saldo"].str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
-        )
+    """Parses an ING CSV export with DuckDB's CSV reader.
 
-    raw_df["account"] = get_account(file_name)
-    raw_df = raw_df[
-        [
-            "account",
-            "book_date",
-            "valuta_date",
-            "party",
-            "book_text",
-            "purpose",
-            "amount",
-            "balance",
-        ]
-    ]
+    DuckDB reads the ISO-8859-1 file directly, starting at the header line. Dates are parsed
+    with an explicit format and the German decimals are converted to integer cents in the
+    same query.
+    """
+    con = duckdb.connect()
+    try:
+        raw_df = con.execute(
+            f"""
+            SELECT
+                ? AS account,
+                strptime(book_date, '%d.%m.%Y') AS book_date,
+                strptime(valuta_date, '%d.%m.%Y') AS valuta_date,
+                party,
+                book_text,
+                purpose,
+                {german_decimal_to_cents_sql('amount')} AS amount_cents,
+                {german_decimal_to_cents_sql('balance')} AS balance_cents
+            FROM read_csv(
+                ?,
+                skip = ?,
+                header = true,
+                delim = ';',
+                quote = '"',
+                escape = '"',
+                encoding = 'latin-1',
+                auto_detect = false,
+                columns = {{
+                    'book_date': 'VARCHAR',
+                    'valuta_date': 'VARCHAR',
+                    'party': 'VARCHAR',
+                    'book_text': 'VARCHAR',
+                    'purpose': 'VARCHAR',
+                    'balance': 'VARCHAR',
+                    'currency': 'VARCHAR',
+                    'amount': 'VARCHAR',
+                    'currency1': 'VARCHAR'
+                }}
+            )
+        """,
+            [get_account(file_name), file_name, count_lines_before(file_name, ING_HEADER)],
+        ).df()
+    finally:
+        con.close()
     return raw_df
 
 
-def categorize_df(df: pd.DataFrame) -> pd.DataFrame:
-    """Sets category column of dataframe."""
-    category_attribute_subs_map: dict[str, dict] = {
-        "anwalt::centurion": {"party": ["zirngibl", "KNH Rechtsanwaelte"]},
-        "bargeld": {"party": ["bargeldauszahlung"], "purpose": ["ING Bargeld Ausz"]},
-        "einkaufen": {
-            "party": [
-                "bio company",
-                "biobackhaus",
-                "VISA DENNS BIOMARKT BERLIN",
-                "edeka",
-                "dm-drogerie",
-                "steinecke",
-                "nah und gut",
-                "visa ralf oelmann",
-                "combi verbrauchermarkt",
-                "tchibo",
-                "REWE MARKT",
-                "VISA REWE VIKTOR ADLER",
-                "VISA LPG BIOMARKT",
-                "VISA BILLA DANKT",
-                "VISA ALDI GMBH",
-                "VISA SUMUP * ADELES CAFE LI",
-                "VISA SCHENKE DELIKATESSEN",
-                "VISA BUDNI SAGT DANKE",
-                "VISA ROSSMANN 2425",
-                "VISA SCHENKE EXPRESSMARKT &",
-            ],
-            "purpose": [
-                "KoRo Handels GmbH",
-                "KoRo Drogerie GmbH",
-                "BIO COMPANY GmbH",
-                "gewuerzland",
-                "BIO COMPANY SE",
-                "Ihr Einkauf bei Flink SE",
-            ],
-        },
-        "einnahmen::dividende": {"purpose": ["dividende", "Smartbroker"]},
-        "einnahmen::gehalt::andreas": {"party": ["andreas edmond profous"]},
-        "freizeit::buch": {
-            "party": ["BUCHHDLG. FERLEMANN", "BUCHHDLG.FERLEMANN+SCHATZER"],
-            "purpose": ["Libri GmbH"],
-        },
-        "freizeit::konzert": {"purpose": ["Eventim AG"]},
-        "freizeit": {"party": ["VISA KANT KINO"]},
-        "freizeit::sport": {"party": ["Katherine Finger", "ELIXIA"]},
-        "gesa::amazon": {
-            "party": [("common", "AMAZON PAYMENTS EUROPE"), ("common", "AMAZON EU S.A R.L.")]
-        },
-        "gesa::dienstreise::unterkunft": {
-            "party": [
-                "VISA THE HENDRICK",
-                "Hostel-Gaestehaus- Kaiserpassage",
-                "VISA HOTEL WALDERHAUS",
-            ]
-        },
-        "gesa::arbeit::software": {"party": ["VISA ZOTERO.ORG", "VISA DEEPL* SUB BTLT6OUUVV6"]},
-        "gesa::friseur": {"party": ["Fahlke Horstmann"]},
-        "geschenk": {
-            "party": ["VISA SPIELVOGEL", "popsa", "Foto Meyer", "VISA TOYS WORLD"],
-            "purpose": ["superiore.de", "geschenk mama", "Marimekko", "SPIELVOGEL"],
-        },
-        "gesundheit": {
-            "party": [
-                "ZAHNARZT DR. MUELLER",
-                "JOSEPHINEN APOTHEKE",
-                "PRAGER APOTHEKE",
-                "FORTUNA APOTHEKE",
-                "PRAGERAPOTHEKE",
-                "VISA PLUSPUNKT APOTHEKE",
-                "VISA ZAHNARZT DR MUELLER",
-                "VISA ADLER - APOTHEKE INH.",
-                "VISA ADLER - APOTHEKE INH.J",
-                "VISA APOTHEKE AM ZOB",
-                "FALKEN SAMMER DEPPNER",  # Beratung PKV
-            ],
-            "purpose": ["Center-Apotheke im Minipreis", "SPEICKSHOP", "SHAVING.IE"],
-        },
-        "gesundheit::debeka": {"party": ["Debeka Kranken-Versicherung-Verein a.G"]},
-        "gesundheit::vorleistung": {
-            "party": [
-                "Dr. Kitty Velmer",
-                "Dr. med. U. Kraffel",
-                "MVZ Hautarztpraxis Wilmersdorf GmbH",
-                "Prof. Dr. med. habil Wolfgang Hardt",
-                "Lungenpraxis Hohenzollerndamm",
-                "Dr.med.Monika Kalus,Dr.med.Jorrit Brunnemann",
-            ],
-        },
-        "handy": {
-            "party": [
-                "congstar - eine Marke der Telekom Deutschland GmbH",
-                "fraenk - eine Marke der Telekom Deutschland GmbH",
-            ]
-        },
-        "kleidung": {
-            "party": [
-                "VISA MAGAZZINO",
-                "Globetrotter",
-                "VISA OUTDOORLADEN GMBH",
-                "Zalando Payments GmbH",
-                "VISA INTERSPORT FINKE",
-                "KLINGENTHAL GMBH",
-                "MAAS NATUR GMBH GUETERSLOH",
-                "Maas Naturwaren GmbH",
-                "VISA THINK STORE",
-                "VISA KLINGENTHAL GUETERSLOH",
-                "VISA HIRSCHMANN MODE",
-                "VISA KIRSTEN WLOTZKE MAST",
-                "VISA MAAS NATUR GMBH",
-                "VISA OSKA",
-            ],
-            "purpose": ["Bestseller Handels B.V"],
-        },
-        "kinder": {
-            "party": [
-                "Musikschule City West",
-                "VISA ZETTLE *BOULDERWORX KL",
-            ],
-            "purpose": ["Zoologischer Garten Be", "Kinderschwimmen", "ECO Brotbox GmbH"],
-        },
-        "kinder::babysitter": {"party": ["Carolina Sgro"]},
-        "kinder::kleidung": {
-            "purpose": [
-                "Kleines Schuhwerk",
-                "Kleine Helden",
-                "Petit Bateau Kinderbekleidung",
-                "finkid GmbH",
-                "greenstories KG",
-                "VISA KLEINE HELDEN",
-                "VISA KLIX - KLEINE SACHEN",
-            ]
-        },
-        "kinder::kindergeld": {"party": ["Bundesagentur fur Arbeit - Familienkasse"]},
-        "kinder::museum": {"party": ["Jugend im Museum e.V."]},
-        "kinder::sparen": {"purpose": ["Sparen Depot Paula", "Sparplan ISIN LU0360863863"]},
-        "kinder::sport": {
-            "party": [
-                "VISA REITSPORT-CENTER",
-                "kokitu / Sascha Splettstoesser",
-                "marameo Berlin e. V.",
-            ]
-        },
-        "kinder::schulekita": {
-            "party": ["NBH Schoeneberg", "Forderverein", "Finow-Grundschule e.V."],
-            "purpose": [
-                "Kassenzeichen: 2134900496613 Paula Profous",
-                "Beitrag fur die Sprachforderung",
-                "Beitrag fuer die Sprachfoerderung",
-            ],
-        },
-        "kinder::theater": {"party": ["Erika Tribbioli"]},
-        "kinder::optiker": {"party": ["Damm Brillen", "VISA DAMM-BRILLEN BERLIN"]},
-        "kinder::reiten": {
-            "party": [
-                "Reit- und Fahrverein Zehlendorf e.V.",
-                "KFRFZ e.V.",
-                "KINDER- UND JUGEND-, REIT- UND FAHRVEREIN ZEHLENDORF E.V.",
-                "Kinder- und Jugend-, Reit- undFahrverein Zehlendorf e.V.",
-                "KINDER- und JUGEND-REIT- und FAHRVEREIN ZEHLENDORF e.V.",
-            ]
-        },
-        "konferenz": {
-            "party": [
-                "VISA MOLLIEDECONGRESBALIE",
-                "VISA MOL*HOTEL ZUIDERDUIN",
-                "VISA IAIA",
-                "VISA TALLINNFORUM.ORG",
-            ]
-        },
-        "justetf": {"party": ["justETF GmbH"]},
-        "media": {
-            "party": [
-                "amznprime",
-                "prime video",
-                "abo lage der nation",
-                "aws emea",
-                "thalia.de",
-                "VISA AUDIBLE.IT",
-                "Stiftung Warentest",
-            ],
-            "purpose": [
-                "Spotify AB",
-                "audible.de",
-                "netflix.com",
-                "PP.2107.PP . SPOTIFY, Ihr Einkauf b ei SPOTIFY",
-                "PP . DisneyPlus, Ihr Einkau f bei DisneyPlus",
-                "Hugendubel Digital GmbH + Co. KG",
-                "Zeit Audio Abo",
-            ],
-        },
-        "mitgliedsbeitraege": {
-            "party": [
-                "Deutscher Hochschulverband",
-                "Naturschutzzentrum Okowerk Berlin e.V.",
-                "Bundnis 90 / Die GRUNEN",
-                "UVP-Gesellschaft e.V.",
-            ]
-        },
-        "mobilitaet::auto": {
-            "party": [
-                "sprint station",
-                "visa shell",
-                "riller & schnauck",
-                "Bundeskasse in Kiel",
-                "VISA STOP + GO SYSTEMZENTRA",
-                "ARAL AG",
-                "Worldline Sweden AB fuer Shell",
-                "VISA ARAL STATION",
-                "VISA STAR TANKSTELLE",
-                "Landeshauptkasse Berlin",
-                "VISA ESSO STATION",
-                "VISA ARAL TANKSTELLE 286077",
-            ],
-        },
-        "mobilitaet::autoleihen": {
-            "party": [
-                "VISA ENTERPRISE RENT A CAR",
-                "VISA RENTALCARS.COM",
-                "VISA SIXT",
-                "VISA WWW.AUTOEUROPE.DE",
-                "VISA GOLDCAR PISA",
-                "VISA AGIP SERVICE-STATION",
-            ]
-        },
-        "mobilitaet::deutschlandticket": {"party": ["S-Bahn Berlin GmbH"]},
-        "mobilitaet::db::oebb:": {"purpose": ["OBB-Personenverkehr AG", "OEBB PV AG"]},
-        "mobilitaet::db": {"party": ["DB Vertrieb GmbH"]},
-        "mobilitaet::faehre": {
-            "party": ["VISA SCANDLINES DEUTSCHLAND", "VISA DIRECTF", "VISA TT-LINE GMBH & CO. KG"]
-        },
-        "mobilitaet::fahrrad": {"party": ["bike market city", "FAHRRADLADEN MEHRINGHOF"]},
-        "mobilitaet::fliegen": {
-            "party": [
-                "RYANAIR",
-                "easyJet",
-                "eurowings GmbH",
-                "VISA LUFTHANSA",
-                "VISA FLIGHTS ON BOOKING.COM",
-                "VISA SWISS.COM",
-                "VISA AUSTRIAN AI",
-            ],
-            "purpose": [
-                "ryanair limited",
-                "deutsche lufthansa",
-                "Koninklijke Luchtvaart Maatschappij",
-            ],
-        },
-        "mobilitaet::oeffentlich": {
-            "party": ["bvg app", "DB Fernverkehr AG"],
-            "purpose": ["DB Vertrieb GmbH"],
-        },
-        "moebel": {"party": ["VISA JALOU CITY GMBH", "JalouCity Heimtextilien", "VISA TYLKO S.A."]},
-        "moebel::bad": {"party": ["VISA MOEVE SHOP"]},
-        "moebel::kueche": {"party": ["VISA ZETTLE *K-TEK KUCHENAR"]},
-        "moebel::beleuchtung": {
-            "party": ["visa elektrowaren prediger", "Elektroanlagen-Technik Pockrandt"],
-        },
-        "moebel::geraete": {"party": ["eShoppen Germany GmbH"]},
-        "intern": {"party": ["andreas profous", "profous", "gesa geissler"]},
-        "intern::rente": {"purpose": ["Wertpapierkauf"], "book_text": ["Wertpapierkauf"]},
-        "intern::steuerklasse": {"purpose": ["Ausgleich Steuerklasse"]},
-        "restaurant": {
-            "party": [
-                "cocolo ramen",
-                "VISA 41 QUARANTUNO",
-                "VISA RENGER PATZSCH",
-                "VISA RESTAURANT MESOB",
-                "VISA RESTAURANT SCHNITZELEI",
-                "VISA CAFE LAMA",
-                "VISA IL MIO RISTORANTE",
-                "VISA KUSHINOYA",
-                "VISA RISTORANTE BOCCACELLI",
-                "VISA KANAAN RESTAURANT",
-                "VISA RESTAURANT PRATIRIO",
-                "VISA LUCA CAFE AM NEUEN SEE",
-                "VISA ALTER HAFEN GASTHAUS",
-                "VISA YOGI HAUS",
-                "HAPPINESSHEART",
-                "VISA SUMUP *HAPPINESS-HEAR",
-                "VISA SUMUP *HAPPINESSHEART",
-                "lieferando.de",
-                "VISA INDIA CLUB",
-                "RESTAURANT APRIL",
-                "VISA RESTAURANT LENZIG",
-                "VISA RESTAURANT KOINONIA",
-                "VISA RESTAURANT BEL MONDO",
-                "RESTAURANT PARACAS",
-                "VISA EATAROUND DELIVERY",
-                "VISA ZIMT UND ZUCKER",
-                "VISA SPC*RESTAURANT BAHADUR",
-                "VISA RESTAURANTE CALIBOCCA",
-                "VISA SY RESTAURANT",
-                "VISA YOGIHAUS",
-                "VISA RESTAURANT APRIL",
-                "VISA PARKCAFE BERLIN",
-                "ADELES CAFE LI",
-                "VISA CAFE REST DEL EUROPE",
-                "VISA SPC*SHARMA UND VIR GBR",
-                "VISA LULA DELI AND GRILL",
-                "VISA SUMUP *LIEN & LOAN",
-                "VISA TOMASA ZEHLENDORF",
-                "VISA SAN MARINO RESTAURANT",
-                "VISA TRATTORIA DA NOI",
-                "VISA INDIAN PALACE",
-                "CAFE KUCHENZEI",
-                "VISA JULES GEISBERG",
-                "VISA SUMUP *CLAUDIOS ARS V",
-                "VISA ANTICA TAVERNA SRL",
-                "VISA CAFFETTERIA DEGLI UFFI",
-                "VISA ZOO GASTRONOMIE",
-                "VISA SUMUP *LIEN LOAN",
-                "VISA BAECKEREI UND KONDITOR",
-                "VISA ALTES GASTHAUS BERMPOH",
-                "VISA LE NAPOLEON",
-                "VISA RESTAURANT A TELHA",
-                "VISA JAPANESE BISTRO",
-                "VISA TOMASA FRIEDENAU",
-                "VISA OSTERIA DEL NONNO",
-            ],
-            "purpose": ["TIAN FU // BERLIN"],
-        },
-        "rente::gesa": {"party": ["DWS Investment GmbH"]},
-        "spenden": {"party": ["Aerzte ohne Grenzen eV", "Arzte ohne Grenzen"]},
-        "urlaub::unterkunft": {
-            "purpose": ["Airbnb Payments", "airbnb"],
-            "party": [
-                "VISA BKG*BOOKING.COM HOTEL",
-                "VISA AIRBNB",
-                "VISA HAMPTON BY HILTON",
-                "VISA ACHAT STERNHOTEL BONN",
-                "VISA PRECISE RESORT MARINA",
-            ],
-        },
-        "urlaub::einkaufen": {
-            "party": [
-                "VISA MENY PRAESTOE I/S",
-                "VISA CIRCLE K BARSE RUNDDEL",
-                "VISA CARREFOUR CONTACT",
-                "VISA CONAD",
-                "VISA UNICOOP FIRENZE",
-                "VISA UNICOOP FI",
-                "VISA SUPERMERCATO PAM",
-            ]
-        },
-        "urlaub::freizeit": {
-            "party": [
-                "VISA KALVEHAVE LABYRINTPARK",
-                "VISA DANMARKS BORGCENTER",
-                "VISA KLETTERWALD GRUNHEIDE",
-            ]
-        },
-        "versicherung::haftpflicht": {
-            "party": ["asspario Versicherungsdienst AG", "ASSPARIO GmbH"]
-        },
-        "versicherung::kfz": {
-            "party": ["HUK-COBURG UNTERNEHMENSGRUPPE"],
-            "purpose": ["CosmosDirekt Kfz Beitrag"],
-        },
-        "versicherung::hausratversichterung": {
-            "party": [
-                "COYA Hausrat",
-                "Getsafe Digital GmbH",
-                "GC RE GETSAFE DIGITAL GMBH",
-                "GC re Getsafe Digital GmbH",
-                "GC re Coya",
-                "GETSAFE",
-            ],
-            "purpose": ["COYA Hausrat"],
-        },
-        "gesundheit::krankenversicherung": {"party": ["ALTE OLDENBURGER Krankenversicherung AG"]},
-        "gesundheit::krankenzusatz": {"party": ["Envivas Krankenversicherung AG"]},
-        "wohnen": {"purpose": ["Rate, Putzen, Naturstrom", "Ausgleich WEG"]},
-        "wohnen::grundsteuer": {"purpose": ["STEUERNR 024/749/07849 GRUNDST"]},
-        "wohnen::GEZ": {"party": ["Rundfunk ARD, ZDF, DRadio"]},
-        "wohnen::strom": {"party": ["NaturStromHandel GmbH"]},
-        "wohnen::internet": {"party": ["1+1 Telecom GmbH"]},
-        "wohnen::putzen": {"party": ["INES BORNEMANN"]},
-        "wohnen::rate": {"purpose": ["Rechnung Darl.-Leistung 6070166475"]},
-        "wohnen::wohngeld": {"party": ["WEG Holsteinische Strase 43 in 10717 Berlin"]},
+def parse_file_frames(
+    file_list: list[str], max_workers: int | None = None
+) -> dict[str, pd.DataFrame]:
+    """Parses ING CSV files concurrently and returns the dataframe of each file.
+
+    Every file is parsed in its own worker process, by default with one worker per file up to
+    the number of CPUs, since DuckDB uses all cores within each worker. A single file is
+    parsed in this process. Parse errors are reported per file and raise a ValueError once
+    all files were tried. The result is ordered by file name, so it does not depend on the
+    order of file_list.
+    """
+    file_names = list(dict.fromkeys(file_list))
+    results: dict[str, pd.DataFrame] = {}
+    errors: dict[str, Exception] = {}
+    if len(file_names) == 1:
+        try:
+            results[file_names[0]] = to_raw_df(file_names[0])
+        except Exception as e:
+            errors[file_names[0]] = e
+    elif file_names:
+        workers = max_workers or min(len(file_names), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {file_name: executor.submit(to_raw_df, file_name) for file_name in file_names}
+            for file_name, future in futures.items():
+                try:
+                    results[file_name] = future.result()
+                except Exception as e:
+                    errors[file_name] = e
+
+    for file_name in file_names:
+        if file_name in errors:
+            typer.echo(f"Failed to parse {file_name}: {errors[file_name]}", err=True)
+        else:
+            typer.echo(f"Parsed {file_name} ({results[file_name].shape[0]} rows)")
+    if errors:
+        raise ValueError(f"{len(errors)} of {len(file_names)} files could not be parsed")
+
+    return {file_name: results[file_name] for file_name in sorted(results)}
+
+
+def parse_files(file_list: list[str], max_workers: int | None = None) -> pd.DataFrame:
+    """Parses ING CSV files concurrently and merges them into one dataframe.
+
+    See parse_file_frames, the dataframes are concatenated in file name order.
+    """
+    return pd.concat(list(parse_file_frames(file_list, max_workers).values()), ignore_index=True)
+
+
+def file_content_hash(file_name: str) -> str:
+    """SHA256 of the file content, which identifies a statement independent of its name."""
+    with open(file_name, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+RULES_PATH = Path(__file__).with_name("rules.yaml")
+RULES_FORMAT_VERSION = 1
+
+
+@cache
+def load_rules(path: Path = RULES_PATH) -> dict[str, dict[str, dict]]:
+    """Reads the category and transfer rule maps from the rules file, see rules.yaml.
+
+    Rules restricted to an account are returned as (account, substring) tuples.
+    """
+    # The C loader is much faster, if PyYAML was built with libyaml
+    with open(path, encoding="utf-8") as f:
+        data = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    if data.get("version") != RULES_FORMAT_VERSION:
+        raise ValueError(
+            f"{path} has version {data.get('version')}, expected {RULES_FORMAT_VERSION}"
+        )
+
+    return {
+        kind: {
+            category: {
+                attribute: [
+                    (sub["account"], sub["sub"]) if isinstance(sub, dict) else sub for sub in subs
+                ]
+                for attribute, subs in subs_map.items()
+            }
+            for category, subs_map in data[kind].items()
+        }
+        for kind in ("category", "transfer")
     }
 
+
+class SubstringMatcher:
+    """Aho-Corasick automaton that finds all patterns contained in a text in a single pass."""
+
+    def __init__(self, patterns: list[str]):
+        self.patterns = patterns
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.out: list[list[int]] = [[]]
+
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].append(pattern_id)
+
+        # Breadth-first construction of the failure links.
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def find(self, text: str) -> set[int]:
+        """Returns the ids of all patterns that occur in text."""
+        found: set[int] = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class CompiledRules:
+    """Substring rules of a category map, numbered in evaluation order.
+
+    A higher rule index means the rule is applied later, i.e. it wins over earlier rules.
+    """
+
+    def __init__(self, categories: list[str], attribute_matchers: dict[str, tuple]):
+        self.categories = categories
+        # attribute -> (matcher, pattern id -> [(rule index, account or None)])
+        self.attribute_matchers = attribute_matchers
+
+
+def rule_list(category_attribute_subs_map: dict[str, dict]) -> list[tuple]:
+    """Flattens a category map into (category, attribute, account, substring) rules.
+
+    The rules are listed in evaluation order. account is None unless the rule was given as
+    an (account, substring) tuple.
+    """
+    rules = []
     for category, subs_map in category_attribute_subs_map.items():
         for attribute, subs in subs_map.items():
             # This is to avoid the mistake that subs is just a string.
             assert isinstance(subs, list)
             for sub_item in subs:
                 if isinstance(sub_item, str):
-                    sub = sub_item
-                    df.loc[
-                        df[attribute].fillna("").str.lower().str.contains(sub.lower(), regex=False),
-                        "category",
-                    ] = category
+                    rules.append((category, attribute, None, sub_item))
                 elif isinstance(sub_item, tuple):
                     account, sub = sub_item
-                    df.loc[
-                        (
-                            df[attribute]
-                            .fillna("")
-                            .str.lower()
-                            .str.contains(sub.lower(), regex=False)
-                        )
-                        & (df.account == account),
-                        "category",
-                    ] = category
-    df.loc[
-        (df.party.fillna("").str.lower().str.contains("VISA APPLE.COM/BILL".lower(), regex=False))
-        & (df.amount > -50),
-        "category",
-    ] = "media"
-
-    df.loc[
-        (df.account == "gesa") & (df.book_text == "Gehalt/Rente"),
-        "category",
-    ] = "einnahmen::gehalt::gesa"
-
-    df.loc[
-        (df.account == "giro")
-        & ((df.party == "Kreuzwerker") | (df.party == "ANDREAS EDMOND PROFOUS")),
-        "category",
-    ] = "einnahmen::gehalt::andreas"
+                    rules.append((category, attribute, account, sub))
+    return rules
+
+
+def compile_rules(rules: list[tuple]) -> CompiledRules:
+    """Compiles rules into one lowercase substring matcher per attribute."""
+    categories: list[str] = []
+    attribute_rules: dict[str, dict[str, list[tuple[int, str | None]]]] = {}
+    for category, attribute, account, sub in rules:
+        pattern_rules = attribute_rules.setdefault(attribute, {})
+        pattern_rules.setdefault(sub.lower(), []).append((len(categories), account))
+        categories.append(category)
+
+    attribute_matchers = {}
+    for attribute, pattern_rules in attribute_rules.items():
+        patterns = list(pattern_rules)
+        attribute_matchers[attribute] = (
+            SubstringMatcher(patterns),
+            [pattern_rules[pattern] for pattern in patterns],
+        )
+    return CompiledRules(categories, attribute_matchers)
 
+
+MATCHER_CACHE_DIR = Path(__file__).with_name(".matcher_cache")
+# Part of the cache key, increase it whenever the attributes of SubstringMatcher or the
+# layout of CompiledRules change, so that older cache files are not loaded.
+MATCHER_FORMAT_VERSION = 1
+
+
+def load_compiled_rules(rules: list[tuple]) -> CompiledRules:
+    """Like compile_rules, but cached on disk keyed by the hash of the rules.
+
+    The matchers are only built again when the rules or MATCHER_FORMAT_VERSION change. The
+    cache holds the plain automaton tables, so it does not depend on the module name panda.py
+    is loaded under. A cache file that cannot be loaded is treated as a miss and rewritten.
+    """
+    cache_key = json.dumps([MATCHER_FORMAT_VERSION, rules])
+    rules_hash = hashlib.sha256(cache_key.encode("utf-8")).hexdigest()
+    cache_path = MATCHER_CACHE_DIR / f"{rules_hash}.pickle"
+    try:
+        with open(cache_path, "rb") as f:
+            categories, matcher_states = pickle.load(f)
+        attribute_matchers = {}
+        for attribute, (state, pattern_rules) in matcher_states.items():
+            matcher = SubstringMatcher([])
+            if state.keys() != vars(matcher).keys():
+                raise ValueError(f"Unexpected matcher attributes in {cache_path}")
+            matcher.__dict__.update(state)
+            attribute_matchers[attribute] = (matcher, pattern_rules)
+        return CompiledRules(categories, attribute_matchers)
+    except Exception:
+        # Missing, truncated or written by an incompatible version
+        pass
+
+    compiled = compile_rules(rules)
+    matcher_states = {
+        attribute: (vars(matcher), pattern_rules)
+        for attribute, (matcher, pattern_rules) in compiled.attribute_matchers.items()
+    }
+    try:
+        MATCHER_CACHE_DIR.mkdir(exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump((compiled.categories, matcher_states), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        typer.echo(f"Could not cache compiled rules: {e}", err=True)
+    return compiled
+
+
+def match_rules(df: pd.DataFrame, rules: CompiledRules) -> np.ndarray:
+    """Returns for each row the index of the last matching rule, or -1 if no rule matches.
+
+    Every distinct lowercased attribute value is scanned once, and the result is broadcast
+    to all rows sharing that value.
+    """
+    best = np.full(len(df), -1, dtype=np.int64)
+    accounts = df["account"].to_numpy(dtype=object)
+    for attribute, (matcher, pattern_rules) in rules.attribute_matchers.items():
+        codes, uniques = pd.factorize(df[attribute].fillna("").astype(str).str.lower())
+        unique_best = np.full(len(uniques), -1, dtype=np.int64)
+        account_rules: dict[int, list[tuple[int, str]]] = {}
+        for code, value in enumerate(uniques):
+            for pattern_id in matcher.find(value):
+                for rule_index, account in pattern_rules[pattern_id]:
+                    if account is None:
+                        unique_best[code] = max(unique_best[code], rule_index)
+                    else:
+                        account_rules.setdefault(code, []).append((rule_index, account))
+
+        best = np.maximum(best, unique_best[codes])
+        for code, code_rules in account_rules.items():
+            for rule_index, account in code_rules:
+                mask = (codes == code) & (accounts == account)
+                best[mask] = np.maximum(best[mask], rule_index)
+    return best
+
+
+def contains_lower(series: pd.Series, sub: str) -> pd.Series:
+    """Case-insensitive substring match as used by the rules, missing values never match."""
+    return series.fillna("").str.lower().str.contains(sub.lower(), regex=False)
+
+
+# Hand-written cases applied after the rules of categorize_df, in order, as
+# (description, condition, category). CATEGORY_SPECIAL_CASES_SQL is the SQL equivalent.
+CATEGORY_SPECIAL_CASES = [
+    (
+        "party VISA APPLE.COM/BILL above -50",
+        lambda df: contains_lower(df.party, "VISA APPLE.COM/BILL") & (amount_cents(df) > -5000),
+        "media",
+    ),
+    (
+        "gesa Gehalt/Rente",
+        lambda df: (df.account == "gesa") & (df.book_text == "Gehalt/Rente"),
+        "einnahmen::gehalt::gesa",
+    ),
+    (
+        "giro Kreuzwerker or ANDREAS EDMOND PROFOUS",
+        lambda df: (df.account == "giro")
+        & ((df.party == "Kreuzwerker") | (df.party == "ANDREAS EDMOND PROFOUS")),
+        "einnahmen::gehalt::andreas",
+    ),
     # This is necessary because the party might be andreas, so it could be overwritten as internal.
-    df.loc[
-        (df.account == "giro")
+    (
+        "giro Smartbroker income",
+        lambda df: (df.account == "giro")
         & (df.purpose.str.contains("Smartbroker", case=False, na=False))
-        & (df.amount > 0),
-        "category",
-    ] = "einnahmen::dividende"
-
-    df.loc[
-        (
-            df.party.fillna("")
-            .str.lower()
-            .str.contains("Finanzamt Charlottenburg".lower(), regex=False)
-        )
+        & (amount_cents(df) > 0),
+        "einnahmen::dividende",
+    ),
+    (
+        "Finanzamt Charlottenburg Gutschrift",
+        lambda df: contains_lower(df.party, "Finanzamt Charlottenburg")
         & (df.book_text == "Gutschrift"),
-        "category",
-    ] = "einnahmen::steuererstattung"
+        "einnahmen::steuererstattung",
+    ),
+]
+
+# Hand-written cases applied before the rules of transfer_categorize
+TRANSFER_SPECIAL_CASES = [
+    (
+        "extra outgoing",
+        lambda df: (amount_cents(df) < 0) & (df["account"] == "extra"),
+        "extra::giro",
+    ),
+]
+
+
+def categorize_df(df: pd.DataFrame) -> pd.DataFrame:
+    """Sets category column of dataframe."""
+    rules = load_compiled_rules(rule_list(load_rules()["category"]))
+    best = match_rules(df, rules)
+    matched = best >= 0
+    if matched.any():
+        df.loc[matched, "category"] = np.array(rules.categories, dtype=object)[best[matched]]
+
+    for _, condition, category in CATEGORY_SPECIAL_CASES:
+        df.loc[condition(df), "category"] = category
 
     return df
 
@@ -528,73 +511,481 @@ def categorize_df(df: pd.DataFrame) -> pd.DataFrame:
 def transfer_categorize(df: pd.DataFrame) -> pd.DataFrame:
     """Adds transfer_category column to df."""
 
-    transfer_category_attribute_subs_map = {
-        "giro::gesa": {"purpose": ["Ausgleich Steuerklasse"]},
-        "giro::common": {
-            "purpose": ["Rate, Putzen, Naturstrom", "Ausgleich WEG", "Sparen Depot Paula"]
-        },
-        "giro::extra": {"purpose": ["giro::extra"]},
-    }
-
-    df.loc[(df["amount"] < 0) & (df["account"] == "extra"), "transfer_category"] = "extra::giro"
+    for _, condition, transfer_category in TRANSFER_SPECIAL_CASES:
+        df.loc[condition(df), "transfer_category"] = transfer_category
 
-    for transfer_category, subs_map in transfer_category_attribute_subs_map.items():
-        for attribute, subs in subs_map.items():
-            for sub in subs:
-                df.loc[
-                    df[attribute].fillna("").str.lower().str.contains(sub.lower(), regex=False),
-                    "transfer_category",
-                ] = transfer_category
+    rules = load_compiled_rules(rule_list(load_rules()["transfer"]))
+    best = match_rules(df, rules)
+    matched = best >= 0
+    if matched.any():
+        df.loc[matched, "transfer_category"] = np.array(rules.categories, dtype=object)[
+            best[matched]
+        ]
 
     return df
 
 
+def rule_statistics(df: pd.DataFrame) -> pd.DataFrame:
+    """Evaluates every rule of transfer_categorize and categorize_df on its own.
+
+    The rules are applied in evaluation order, including the special cases. Per rule,
+    matches counts the matched rows, overwrites the matched rows that an earlier rule of the
+    same kind already assigned and wins the rows the rule assigns in the end. seconds is the
+    time spent matching the rule. df is not modified.
+    """
+    rules = load_rules()
+    accounts = df["account"].to_numpy(dtype=object)
+    # The distinct lowercased values are shared by all rules, so they are not timed per rule
+    attributes = {rule[1] for kind in ("transfer", "category") for rule in rule_list(rules[kind])}
+    factorized = {}
+    for attribute in sorted(attributes):
+        codes, uniques = pd.factorize(df[attribute].fillna("").astype(str).str.lower())
+        factorized[attribute] = (codes, pd.Series(uniques, dtype=object))
+
+    def rule_matches(attribute: str, account: str | None, sub: str) -> np.ndarray:
+        codes, uniques = factorized[attribute]
+        matched = uniques.str.contains(sub.lower(), regex=False).to_numpy()[codes]
+        return matched if account is None else matched & (accounts == account)
+
+    def special_case_matches(condition) -> np.ndarray:
+        return condition(df).fillna(False).to_numpy(dtype=bool)
+
+    stats = []
+    for kind, before, rule_map, after in (
+        ("transfer", TRANSFER_SPECIAL_CASES, rules["transfer"], []),
+        ("category", [], rules["category"], CATEGORY_SPECIAL_CASES),
+    ):
+        steps = (
+            [
+                ("special", None, description, category, partial(special_case_matches, condition))
+                for description, condition, category in before
+            ]
+            + [
+                (attribute, account, sub, category, partial(rule_matches, attribute, account, sub))
+                for category, attribute, account, sub in rule_list(rule_map)
+            ]
+            + [
+                ("special", None, description, category, partial(special_case_matches, condition))
+                for description, condition, category in after
+            ]
+        )
+        assigned = np.full(len(df), -1, dtype=np.int64)
+        kind_stats = []
+        for rule_index, (attribute, account, sub, category, matches) in enumerate(steps):
+            start = time.perf_counter()
+            matched = matches()
+            seconds = time.perf_counter() - start
+            kind_stats.append(
+                {
+                    "kind": kind,
+                    "rule_index": rule_index,
+                    "category": category,
+                    "attribute": attribute,
+                    "account": account,
+                    "sub": sub,
+                    "matches": int(matched.sum()),
+                    "overwrites": int((matched & (assigned >= 0)).sum()),
+                    "seconds": seconds,
+                }
+            )
+            assigned[matched] = rule_index
+
+        wins = np.bincount(assigned[assigned >= 0], minlength=len(steps))
+        for rule_stats, rule_wins in zip(kind_stats, wins):
+            rule_stats["wins"] = int(rule_wins)
+        stats.extend(kind_stats)
+
+    return pd.DataFrame(stats)
+
+
 def add_cat(df: pd.DataFrame) -> pd.DataFrame:
     """Adds cat column to df. It's the "final" category"""
     # Some values in category_manual are the empty string, some .nan => treat as .nan everywhere
-    df["category_manual"] = df["category_manual"].replace(r"^\s*$", np.nan, regex=True)
-    df["cat"] = df["category_manual"]
-    df["cat"] = df["cat"].where(~df["category_manual"].isna(), df["category"])
+    manual = df["category_manual"].astype(object)
+    manual = manual.where(~manual.str.fullmatch(r"\s*", na=False))
+    df["cat"] = manual.where(~manual.isna(), df["category"].astype(object))
+    if isinstance(df["category"].dtype, pd.CategoricalDtype):
+        # Keep the compact dtype of load_pc_from_db(compact=True)
+        df["cat"] = df["cat"].astype("category")
     return df.drop(columns=["category", "category_manual"])
 
 
+# Bump whenever CATEGORY_SPECIAL_CASES or TRANSFER_SPECIAL_CASES change, so that every row gets
+# categorized again.
+SPECIAL_RULES_VERSION = 1
+
+
+def current_rule_set() -> dict:
+    """Returns the rules used by categorize_pipeline in a JSON-serializable form."""
+    return {
+        "special_rules_version": SPECIAL_RULES_VERSION,
+        "category": [list(rule) for rule in rule_list(load_rules()["category"])],
+        "transfer": [list(rule) for rule in rule_list(load_rules()["transfer"])],
+    }
+
+
+def rule_set_hash(rule_set: dict) -> str:
+    """Generate deterministic hash identifying a rule set."""
+    return hashlib.sha256(json.dumps(rule_set, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def changed_rules(old_rules: list, new_rules: list) -> list[tuple] | None:
+    """Returns the rules that were added or removed between two rule lists.
+
+    Returns None if rules present in both lists changed their relative order, since then
+    any row matching more than one rule might end up in a different category.
+    """
+    old = [tuple(rule) for rule in old_rules]
+    new = [tuple(rule) for rule in new_rules]
+    old_set, new_set = set(old), set(new)
+    if [rule for rule in old if rule in new_set] != [rule for rule in new if rule in old_set]:
+        return None
+    removed = [rule for rule in old if rule not in new_set]
+    added = [rule for rule in new if rule not in old_set]
+    return removed + added
+
+
+def affected_by_rule_change(df: pd.DataFrame, old_rule_set: dict, new_rule_set: dict) -> np.ndarray:
+    """Returns a mask of the rows whose categorization can differ between two rule sets.
+
+    Only the attribute columns referenced by added or removed rules are scanned.
+    """
+    if old_rule_set["special_rules_version"] != new_rule_set["special_rules_version"]:
+        return np.ones(len(df), dtype=bool)
+
+    affected = np.zeros(len(df), dtype=bool)
+    for kind in ("category", "transfer"):
+        rules = changed_rules(old_rule_set[kind], new_rule_set[kind])
+        if rules is None:
+            return np.ones(len(df), dtype=bool)
+        if rules:
+            affected |= match_rules(df, compile_rules(rules)) >= 0
+    return affected
+
+
+def sql_string(value: str) -> str:
+    """Quotes value as an SQL string literal."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def rule_condition_sql(attribute: str, account: str | None, sub: str) -> str:
+    """SQL equivalent of a single rule as matched by match_rules.
+
+    The substring is searched in the distinct values of the dimension table of the attribute,
+    see DIMENSION_TABLES, and the transactions are selected by their value ids.
+    """
+    condition = (
+        f"{attribute}_id IN (SELECT id FROM {DIMENSION_TABLES[attribute]}"
+        f" WHERE contains(lower(value), {sql_string(sub.lower())}))"
+    )
+    if account is not None:
+        condition = f"(account = {sql_string(account)} AND {condition})"
+    return condition
+
+
+# SQL equivalents of CATEGORY_SPECIAL_CASES, in the same order
+CATEGORY_SPECIAL_CASES_SQL = [
+    (
+        "contains(lower(COALESCE(party, '')), 'visa apple.com/bill') AND amount_cents > -5000",
+        "media",
+    ),
+    ("account = 'gesa' AND book_text = 'Gehalt/Rente'", "einnahmen::gehalt::gesa"),
+    (
+        "account = 'giro' AND party IN ('Kreuzwerker', 'ANDREAS EDMOND PROFOUS')",
+        "einnahmen::gehalt::andreas",
+    ),
+    (
+        "account = 'giro' AND contains(lower(purpose), 'smartbroker') AND amount_cents > 0",
+        "einnahmen::dividende",
+    ),
+    (
+        "contains(lower(COALESCE(party, '')), 'finanzamt charlottenburg')"
+        " AND book_text = 'Gutschrift'",
+        "einnahmen::steuererstattung",
+    ),
+]
+
+# SQL equivalent of TRANSFER_SPECIAL_CASES, applied before the rules
+TRANSFER_SPECIAL_CASES_SQL = [("amount_cents < 0 AND account = 'extra'", "extra::giro")]
+
+
+def case_sql(column: str, assignments: list[tuple[str, str]]) -> str:
+    """Returns a CASE expression that applies the (condition, value) assignments in order.
+
+    Later assignments overwrite earlier ones, as with consecutive df.loc assignments, so the
+    conditions are tested in reverse order. Rows without a match keep their value.
+    """
+    whens = "".join(
+        f"\n    WHEN {condition} THEN {sql_string(value)}"
+        for condition, value in reversed(assignments)
+    )
+    return f"CASE{whens}\n    ELSE {column}\nEND"
+
+
+def categorize_sql() -> dict[str, str]:
+    """Compiles transfer_categorize and categorize_df into expressions per column.
+
+    The rules are matched beforehand by match_rules_db, whose matched_transfer_category and
+    matched_category hold the category of the last matching rule of each kind. Transfer rules
+    win over the transfer special case, the category special cases win over the rules.
+    """
+    transfer_special_cases = case_sql("transfer_category", TRANSFER_SPECIAL_CASES_SQL)
+    return {
+        "transfer_category": f"COALESCE(matched_transfer_category, {transfer_special_cases})",
+        "category": case_sql("COALESCE(matched_category, category)", CATEGORY_SPECIAL_CASES_SQL),
+    }
+
+
+def match_rules_db(con: duckdb.DuckDBPyConnection, where: str, params: list | None = None):
+    """Matches the rules against the transactions selected by where, see categorize_sql.
+
+    Each rule is tested once per distinct value in the dimension tables instead of once per
+    transaction, and the last matching rule of each kind is then broadcast to the transactions
+    through their value ids. The result is the temp table matched with one row per selected
+    transaction.
+    """
+    rule_df = pd.DataFrame(
+        [
+            (kind, rule_index, category, attribute, account, sub.lower())
+            for kind in ("transfer", "category")
+            for rule_index, (category, attribute, account, sub) in enumerate(
+                rule_list(load_rules()[kind])
+            )
+        ],
+        columns=["kind", "rule_index", "rule_category", "attribute", "rule_account", "sub"],
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE selected AS
+        SELECT transaction_id, account, party_id, book_text_id, purpose_id
+        FROM transactions
+        WHERE {where}
+        """,
+        params or [],
+    )
+    # Only the values of the selected transactions are matched
+    value_matches = " UNION ALL ".join(
+        f"""
+        SELECT r.kind, r.rule_index, r.rule_category, r.rule_account, r.attribute, d.id AS value_id
+        FROM rule_df AS r
+        JOIN (
+            SELECT id, lower(value) AS lowered FROM {table}
+            WHERE id IN (SELECT {attribute}_id FROM selected)
+        ) AS d ON contains(d.lowered, r.sub)
+        WHERE r.attribute = '{attribute}'
+        """
+        for attribute, table in DIMENSION_TABLES.items()
+    )
+    con.execute(f"CREATE OR REPLACE TEMP TABLE rule_matches AS {value_matches}")
+    transaction_matches = " UNION ALL ".join(
+        f"""
+        SELECT s.transaction_id, m.kind, m.rule_index, m.rule_category
+        FROM selected AS s
+        JOIN rule_matches AS m ON m.attribute = '{attribute}' AND m.value_id = s.{attribute}_id
+        WHERE m.rule_account IS NULL OR m.rule_account = s.account
+        """
+        for attribute in DIMENSION_TABLES
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE matched AS
+        SELECT
+            s.transaction_id AS matched_id,
+            arg_max(t.rule_category, t.rule_index) FILTER (WHERE t.kind = 'transfer')
+                AS matched_transfer_category,
+            arg_max(t.rule_category, t.rule_index) FILTER (WHERE t.kind = 'category')
+                AS matched_category
+        FROM selected AS s
+        LEFT JOIN ({transaction_matches}) AS t USING (transaction_id)
+        GROUP BY s.transaction_id
+        """
+    )
+
+
+def affected_by_rule_change_sql(old_rule_set: dict, new_rule_set: dict) -> str:
+    """SQL condition equivalent to affected_by_rule_change."""
+    if old_rule_set["special_rules_version"] != new_rule_set["special_rules_version"]:
+        return "true"
+
+    conditions = []
+    for kind in ("category", "transfer"):
+        rules = changed_rules(old_rule_set[kind], new_rule_set[kind])
+        if rules is None:
+            return "true"
+        conditions.extend(
+            rule_condition_sql(attribute, account, sub) for _, attribute, account, sub in rules
+        )
+    return f"({' OR '.join(conditions)})" if conditions else "false"
+
+
 # DuckDB Functions
 
 
 def get_db_path() -> Path:
-    """Get the path to the DuckDB database file."""
-    return Path("pandacount.duckdb")
+    """Get the path to the DuckDB database file, PANDACOUNT_DB overrides the default."""
+    return Path(os.environ.get("PANDACOUNT_DB", "pandacount.duckdb"))
+
+
+def get_snapshot_path() -> Path:
+    """Get the path of the snapshot published for readers, next to the database file."""
+    db_path = get_db_path()
+    return db_path.with_name(f"{db_path.stem}.snapshot{db_path.suffix}")
+
+
+def data_version() -> tuple[int, ...]:
+    """Returns the modification times of the database, its WAL and the snapshot.
+
+    Every commit and every published snapshot changes one of them, so readers can cache
+    results per version.
+    """
+    db_path = get_db_path()
+    version = []
+    for path in (db_path, db_path.with_name(db_path.name + ".wal"), get_snapshot_path()):
+        try:
+            version.append(path.stat().st_mtime_ns)
+        except FileNotFoundError:
+            version.append(0)
+    return tuple(version)
+
+
+# Seconds to wait for a conflicting lock of another process, see connect. DuckDB lets either
+# one process write a database file or any number of processes read it.
+LOCK_TIMEOUT = 60.0
 
 
-def generate_fingerprint(row: pd.Series) -> str:
-    """Generate deterministic fingerprint from natural key fields.
+def is_lock_conflict(error: Exception) -> bool:
+    """Whether error is DuckDB's failure to lock a file that another process has open."""
+    return isinstance(error, duckdb.IOException) and "Could not set lock" in str(error)
 
-    Natural key: account, book_date, valuta_date, party, book_text, purpose, amount_cents
+
+def connect(
+    path: Path, read_only: bool = False, timeout: float = LOCK_TIMEOUT
+) -> duckdb.DuckDBPyConnection:
+    """Connects to the database file at path, retrying while another process holds its lock.
+
+    Readers only keep their connection while they load, and writers like watch only while
+    they write a batch, so the lock is usually free again within seconds.
     """
-    # Convert date to ISO string for consistency
-    book_date_str = row["book_date"].strftime("%Y-%m-%d") if pd.notna(row["book_date"]) else ""
-    valuta_date_str = (
-        row["valuta_date"].strftime("%Y-%m-%d") if pd.notna(row["valuta_date"]) else ""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return duckdb.connect(str(path), read_only=read_only)
+        except duckdb.IOException as e:
+            if not is_lock_conflict(e) or time.monotonic() >= deadline:
+                raise
+        time.sleep(0.1)
+
+
+def reader_connection() -> duckdb.DuckDBPyConnection:
+    """Opens a read-only connection for readers like the notebook and the dashboard.
+
+    Readers open the database itself, so they see all committed transactions. While a writer
+    holds the database, they read the last published snapshot instead and say so, see
+    publish_snapshot. Only without a snapshot of the current schema do they wait for the
+    writer. Readers never write, so a database with an older schema raises a ValueError.
+    """
+    db_path = get_db_path()
+    try:
+        con = connect(db_path, read_only=True, timeout=0)
+    except duckdb.IOException as e:
+        if not is_lock_conflict(e):
+            raise
+        snapshot = open_snapshot()
+        if snapshot is not None:
+            published_at = datetime.fromtimestamp(get_snapshot_path().stat().st_mtime)
+            typer.echo(
+                f"{db_path} is being written, reading the snapshot of"
+                f" {published_at:%Y-%m-%d %H:%M}",
+                err=True,
+            )
+            return snapshot
+        con = connect(db_path, read_only=True)
+    if not schema_is_current(con):
+        con.close()
+        raise ValueError(
+            f"{db_path} has an outdated schema, run a writing command like"
+            " ./panda.py categorize first to update it"
+        )
+    return con
+
+
+def open_snapshot() -> duckdb.DuckDBPyConnection | None:
+    """Opens the published snapshot read-only, or returns None without one of the current schema."""
+    snapshot_path = get_snapshot_path()
+    if not snapshot_path.exists():
+        return None
+    con = duckdb.connect(str(snapshot_path), read_only=True)
+    if not schema_is_current(con):
+        con.close()
+        return None
+    return con
+
+
+# Version of the schema created by create_tables, increased with every migration it gains
+SCHEMA_VERSION = 1
+
+
+def schema_is_current(con: duckdb.DuckDBPyConnection) -> bool:
+    """Whether the database of con has the schema of SCHEMA_VERSION, see create_tables."""
+    has_version = con.execute(
+        """
+        SELECT count(*) FROM duckdb_tables()
+        WHERE database_name = current_database() AND schema_name = current_schema()
+            AND table_name = 'schema_version'
+        """
+    ).fetchone()[0]
+    if not has_version:
+        return False
+    return con.execute("SELECT max(version) FROM schema_version").fetchone()[0] == SCHEMA_VERSION
+
+
+def fingerprint_key_sql(fingerprint: str) -> str:
+    """SQL converting a hex SHA256 fingerprint into the stored UHUGEINT key.
+
+    The key is the first 128 bits of the hash. It is half the size of the raw digest and a
+    quarter of the hex text, and a collision needs around 2^64 transactions.
+    """
+    return (
+        f"((('0x' || substr({fingerprint}, 1, 16))::UBIGINT::UHUGEINT << 64)"
+        f" | ('0x' || substr({fingerprint}, 17, 16))::UBIGINT::UHUGEINT)"
     )
 
-    # Handle None/NaN values consistently
-    account = str(row["account"]) if pd.notna(row["account"]) else ""
-    party = str(row["party"]) if pd.notna(row["party"]) else ""
-    book_text = str(row["book_text"]) if pd.notna(row["book_text"]) else ""
-    purpose = str(row["purpose"]) if pd.notna(row["purpose"]) else ""
-    amount_cents = str(row["amount_cents"]) if pd.notna(row["amount_cents"]) else "0"
 
-    # Combine all fields with separator
-    combined = (
-        f"{account}|{book_date_str}|{valuta_date_str}|{party}|{book_text}|{purpose}|{amount_cents}"
+# SHA256 of the natural key account|book_date|valuta_date|party|book_text|purpose|amount_cents,
+# with ISO dates and empty strings for missing values. Stored fingerprints were computed with
+# this exact format, so changing it means existing rows are no longer deduplicated.
+FINGERPRINT_HEX_SQL = """
+    sha256(
+        COALESCE(CAST(account AS TEXT), '')
+        || '|' || COALESCE(strftime(book_date, '%Y-%m-%d'), '')
+        || '|' || COALESCE(strftime(valuta_date, '%Y-%m-%d'), '')
+        || '|' || COALESCE(CAST(party AS TEXT), '')
+        || '|' || COALESCE(CAST(book_text AS TEXT), '')
+        || '|' || COALESCE(CAST(purpose AS TEXT), '')
+        || '|' || COALESCE(CAST(amount_cents AS TEXT), '0')
     )
+"""
+
 
-    # Generate SHA256 hash
-    return hashlib.sha256(combined.encode("utf-8")).hexdigest()
+def fingerprinted_sql(relation: str) -> str:
+    """SQL selecting the rows of relation with their fingerprint key."""
+    return f"""
+        SELECT * EXCLUDE (fingerprint_hex), {fingerprint_key_sql("fingerprint_hex")} AS fingerprint
+        FROM (SELECT *, {FINGERPRINT_HEX_SQL} AS fingerprint_hex FROM {relation})
+    """
 
 
-def create_tables(con: duckdb.DuckDBPyConnection):
-    """Create the database schema if it doesn't exist."""
+# Physical order of the transactions table. Rows are written in this order, so that the
+# min/max zone maps of each row group let DuckDB skip row groups for date and account filters.
+TRANSACTION_ORDER = "book_date, account, valuta_date, party, purpose"
+
+
+def create_transactions_table(con: duckdb.DuckDBPyConnection):
+    """Create the transactions table if it doesn't exist, and add the columns of newer versions.
+
+    New tables are created with all columns. DuckDB cannot replay a WAL in which a table is
+    created and then altered, so ALTER TABLE only runs for older tables that lack a column.
+    """
     con.execute(
         """
         CREATE TABLE IF NOT EXISTS transactions (
@@ -610,169 +1001,1370 @@ def create_tables(con: duckdb.DuckDBPyConnection):
             transfer_category TEXT,
             category TEXT,
             category_manual TEXT,
-            fingerprint TEXT NOT NULL UNIQUE,
-            imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            fingerprint UHUGEINT NOT NULL UNIQUE,
+            imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            rule_hash TEXT,
+            party_id INTEGER,
+            book_text_id INTEGER,
+            purpose_id INTEGER
         )
     """
     )
+    columns = {
+        column
+        for (column,) in con.execute(
+            """
+            SELECT column_name FROM duckdb_columns()
+            WHERE database_name = current_database() AND schema_name = current_schema()
+                AND table_name = 'transactions'
+            """
+        ).fetchall()
+    }
+    # Hash of the rule set that last categorized the row, see categorize_incremental, and the
+    # ids of the values in the dimension tables, see sync_dimensions
+    added_columns = {"rule_hash": "TEXT"} | {
+        f"{attribute}_id": "INTEGER" for attribute in DIMENSION_TABLES
+    }
+    for column, column_type in added_columns.items():
+        if column not in columns:
+            con.execute(f"ALTER TABLE transactions ADD COLUMN {column} {column_type}")
 
 
-def load_pc_from_db() -> pd.DataFrame:
-    """Load transactions from DuckDB database.
+def migrate_fingerprints(con: duckdb.DuckDBPyConnection):
+    """Converts the hex TEXT fingerprints of older databases to keys, see fingerprint_key_sql.
 
-    Converts amount_cents and balance_cents back to decimal for pandas compatibility.
+    A column with a UNIQUE constraint cannot change its type, so the table is rebuilt in a
+    single transaction.
     """
-    db_path = get_db_path()
+    print("Converting fingerprints to 128-bit keys...")
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.execute(
+            f"""
+            CREATE TEMP TABLE migrated AS
+            SELECT * REPLACE ({fingerprint_key_sql("fingerprint")} AS fingerprint)
+            FROM transactions
+            """
+        )
+        con.execute("DROP TABLE transactions")
+        create_transactions_table(con)
+        con.execute(
+            f"INSERT INTO transactions BY NAME SELECT * FROM migrated ORDER BY {TRANSACTION_ORDER}"
+        )
+        con.execute("DROP TABLE migrated")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    print("Run ./panda.py compact to release the space of the old fingerprints.")
 
-    if not db_path.exists():
-        return pd.DataFrame()
 
-    con = duckdb.connect(str(db_path))
-    try:
-        df = con.execute(
+def create_tables(con: duckdb.DuckDBPyConnection):
+    """Create the database schema if it doesn't exist, and migrate older schemas."""
+    has_value_ids = con.execute(
+        """
+        SELECT count(*) FROM duckdb_columns()
+        WHERE database_name = current_database() AND schema_name = current_schema()
+            AND table_name = 'transactions' AND column_name = 'party_id'
+        """
+    ).fetchone()[0]
+    create_transactions_table(con)
+    fingerprint_type = con.execute(
+        """
+        SELECT data_type FROM duckdb_columns()
+        WHERE database_name = current_database() AND schema_name = current_schema()
+            AND table_name = 'transactions' AND column_name = 'fingerprint'
+        """
+    ).fetchone()[0]
+    if fingerprint_type == "VARCHAR":
+        migrate_fingerprints(con)
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rule_sets (
+            rule_hash TEXT PRIMARY KEY,
+            rules TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """
+    )
+    # Statement files that were imported, see ing_import. A file is identified by the hash of
+    # its content. The fingerprints are hashes, so the fingerprint range of a file overlaps the
+    # rows of other files: it is only a sanity check and does not identify the file's rows.
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS imported_files (
+            content_hash TEXT PRIMARY KEY,
+            file_name TEXT NOT NULL,
+            account TEXT NOT NULL,
+            n_rows INTEGER NOT NULL,
+            min_fingerprint UHUGEINT,
+            max_fingerprint UHUGEINT,
+            imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """
+    )
+    # Distinct parties, book texts and purposes, see sync_dimensions
+    for table in DIMENSION_TABLES.values():
+        con.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        """
+        )
+    if not has_value_ids:
+        sync_dimensions(con, "transactions")
+        for attribute, table in DIMENSION_TABLES.items():
+            con.execute(
+                f"""
+                UPDATE transactions SET {attribute}_id = d.id
+                FROM {table} AS d
+                WHERE transactions.{attribute} = d.value
+                """
+            )
+    # Per-rule statistics of rule_statistics, one set of rows per run
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rule_stats (
+            run_at TIMESTAMP NOT NULL,
+            rule_hash TEXT NOT NULL,
+            n_rows INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            rule_index INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            attribute TEXT NOT NULL,
+            account TEXT,
+            sub TEXT NOT NULL,
+            matches INTEGER NOT NULL,
+            overwrites INTEGER NOT NULL,
+            wins INTEGER NOT NULL,
+            seconds DOUBLE NOT NULL
+        )
+    """
+    )
+    # Category dimension, see sync_categories
+    con.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS categories (
+            category_id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            parent_id INTEGER,
+            level INTEGER NOT NULL,
+            lft INTEGER NOT NULL,
+            rgt INTEGER NOT NULL,
+            {", ".join(f"level{level}_id INTEGER" for level in range(1, CATEGORY_LEVELS + 1))}
+        )
+    """
+    )
+    # Sums per month, account, effective category (see CAT_SQL) and transfer flag, kept up to
+    # date by refresh_monthly_rollup whenever transactions are written
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS monthly_rollup (
+            month DATE NOT NULL,
+            account TEXT NOT NULL,
+            cat TEXT,
+            cat_id INTEGER,
+            transfer BOOLEAN NOT NULL,
+            n_rows INTEGER NOT NULL,
+            amount_cents BIGINT NOT NULL
+        )
+    """
+    )
+    if con.execute("SELECT count(*) FROM monthly_rollup").fetchone()[0] == 0:
+        refresh_monthly_rollup(con)
+    # Readers cannot migrate the schema, so they check this version, see schema_is_current
+    con.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    if con.execute("SELECT max(version) FROM schema_version").fetchone()[0] != SCHEMA_VERSION:
+        con.execute("DELETE FROM schema_version")
+        con.execute("INSERT INTO schema_version VALUES (?)", [SCHEMA_VERSION])
+
+
+# Dimension tables of the free text attributes of transactions, which reference their values
+# by id in the <attribute>_id columns. They pay for the extra ids because the rules are tested
+# once per distinct value instead of once per transaction, see match_rules_db, and incremental
+# runs only test the values of the selected transactions. transactions keeps the text columns
+# as well, since the fingerprints, the loaders and the pandas categorizer read them, and
+# DuckDB dictionary-compresses their repeated values.
+DIMENSION_TABLES = {"party": "parties", "book_text": "book_texts", "purpose": "purposes"}
+
+
+def sync_dimensions(con: duckdb.DuckDBPyConnection, relation: str):
+    """Adds the parties, book texts and purposes of relation to the dimension tables.
+
+    New values get the next free ids, the ids of known values never change.
+    """
+    for attribute, table in DIMENSION_TABLES.items():
+        con.execute(
+            f"""
+            INSERT INTO {table} (id, value)
+            SELECT
+                (SELECT COALESCE(MAX(id), 0) FROM {table}) + row_number() OVER (ORDER BY value),
+                value
+            FROM (
+                SELECT DISTINCT {attribute} AS value FROM {relation} WHERE {attribute} IS NOT NULL
+            )
+            ANTI JOIN {table} USING (value)
             """
+        )
+
+
+# Number of per-level ancestor ids of the categories table, level1_id to level3_id
+CATEGORY_LEVELS = 3
+
+
+def category_ancestors(path: str) -> list[str]:
+    """Returns the paths of a category and its ancestors, root first: a, a::b for a::b."""
+    parts = path.split("::")
+    return ["::".join(parts[: i + 1]) for i in range(len(parts))]
+
+
+def category_rows(ids: dict[str, int]) -> pd.DataFrame:
+    """Returns the rows of the categories table for category paths and their ids.
+
+    The paths must include all their ancestors. They are numbered in preorder as a nested
+    set, so the subtree of a category are the categories whose lft lies in its [lft, rgt].
+    """
+    rows = []
+    open_rows: list[dict] = []
+    counter = 0
+    for path in sorted(ids, key=lambda path: path.split("::")):
+        while open_rows and not path.startswith(open_rows[-1]["path"] + "::"):
+            open_rows.pop()["rgt"] = counter
+            counter += 1
+        ancestors = category_ancestors(path)
+        row = {
+            "category_id": ids[path],
+            "path": path,
+            "name": path.split("::")[-1],
+            "parent_id": ids[ancestors[-2]] if len(ancestors) > 1 else None,
+            "level": len(ancestors),
+            "lft": counter,
+            "rgt": None,
+        }
+        for level in range(1, CATEGORY_LEVELS + 1):
+            row[f"level{level}_id"] = ids[ancestors[level - 1]] if level <= len(ancestors) else None
+        counter += 1
+        rows.append(row)
+        open_rows.append(row)
+    while open_rows:
+        open_rows.pop()["rgt"] = counter
+        counter += 1
+    return pd.DataFrame(rows, columns=list(rows[0]) if rows else None)
+
+
+def sync_categories(con: duckdb.DuckDBPyConnection, cats_sql: str, params: list | None = None):
+    """Adds the categories in the cat column of cats_sql and their ancestors to categories.
+
+    New categories get the next free ids, the ids of known categories never change. The
+    nested set numbers are recomputed for all categories, which are a few hundred at most.
+    """
+    cats = con.execute(
+        f"SELECT DISTINCT cat FROM ({cats_sql}) WHERE cat IS NOT NULL", params or []
+    ).fetchall()
+    ids = dict(con.execute("SELECT path, category_id FROM categories").fetchall())
+    new_paths = sorted({path for (cat,) in cats for path in category_ancestors(cat)} - set(ids))
+    if not new_paths:
+        return
+
+    next_id = max(ids.values(), default=0) + 1
+    ids.update({path: next_id + i for i, path in enumerate(new_paths)})
+    category_df = category_rows(ids)
+    con.execute("DELETE FROM categories")
+    con.execute("INSERT INTO categories BY NAME SELECT * FROM category_df")
+
+
+def category_subtree_sql(paths: list[str]) -> str:
+    """SQL selecting the ids of the categories in the subtrees of paths."""
+    return f"""
+        SELECT below.category_id FROM categories AS below
+        JOIN categories AS above ON below.lft BETWEEN above.lft AND above.rgt
+        WHERE above.path IN ({", ".join(sql_string(path) for path in paths) or "NULL"})
+    """
+
+
+# First day of the month of book_date
+MONTH_SQL = "CAST(date_trunc('month', book_date) AS DATE)"
+
+
+def changed_months(
+    con: duckdb.DuckDBPyConnection, rows_sql: str, params: list | None = None
+) -> list[date]:
+    """Returns the months of the book dates of the rows selected by rows_sql."""
+    return [
+        month
+        for (month,) in con.execute(
+            f"SELECT DISTINCT {MONTH_SQL} FROM ({rows_sql}) ORDER BY 1", params or []
+        ).fetchall()
+    ]
+
+
+def refresh_monthly_rollup(con: duckdb.DuckDBPyConnection, months: list[date] | None = None):
+    """Recomputes the monthly_rollup rows of the given months, or of all months if None.
+
+    Writers collect the months of the rows they insert or recategorize with changed_months,
+    so only those months are aggregated again. New categories are added to categories first,
+    see sync_categories.
+    """
+    if months is None:
+        con.execute("DELETE FROM monthly_rollup")
+        where, params = "true", []
+    elif not months:
+        return
+    else:
+        placeholders = ", ".join("?" for _ in months)
+        con.execute(f"DELETE FROM monthly_rollup WHERE month IN ({placeholders})", months)
+        # The book date range lets DuckDB skip the row groups of other months
+        where = (
+            "book_date >= ? AND book_date < CAST(? AS DATE) + INTERVAL 1 MONTH"
+            f" AND {MONTH_SQL} IN ({placeholders})"
+        )
+        params = [min(months), max(months), *months]
+    sync_categories(con, f"SELECT {CAT_SQL} AS cat FROM transactions WHERE {where}", params)
+    con.execute(
+        f"""
+        INSERT INTO monthly_rollup BY NAME
+        SELECT sums.*, categories.category_id AS cat_id
+        FROM (
             SELECT
+                {MONTH_SQL} AS month,
                 account,
-                book_date,
-                valuta_date,
-                party,
-                book_text,
-                purpose,
-                amount_cents,
-                balance_cents,
-                transfer_category,
-                category,
-                category_manual
+                {CAT_SQL} AS cat,
+                transfer_category IS NOT NULL AS transfer,
+                count(*) AS n_rows,
+                sum(amount_cents) AS amount_cents
             FROM transactions
-            ORDER BY book_date, account, valuta_date, party, purpose
-        """
-        ).df()
+            WHERE {where}
+            GROUP BY ALL
+        ) AS sums
+        LEFT JOIN categories ON categories.path = sums.cat
+        ORDER BY month, account, cat, transfer
+        """,
+        params,
+    )
 
-        # Convert cents back to decimal amounts
-        df["amount"] = df["amount_cents"] / 100.0
-        df["balance"] = df["balance_cents"] / 100.0
 
-        # Drop the cents columns (keep only decimal versions for pandas)
-        df = df.drop(columns=["amount_cents", "balance_cents"])
+@contextmanager
+def db_connection(con: duckdb.DuckDBPyConnection | None = None, reader: bool = False):
+    """Yields con, or a new connection to the database that is closed afterwards.
 
-        return df
+    Functions that touch the database take an optional connection, so that several steps
+    can share one connection and transaction. reader=True opens a read-only connection, see
+    reader_connection.
+    """
+    if con is not None:
+        yield con
+        return
+
+    if reader:
+        con = reader_connection()
+    else:
+        con = connect(get_db_path())
+        create_tables(con)
+    try:
+        yield con
     finally:
         con.close()
 
 
-def save_pc_to_db(pc: pd.DataFrame):
-    """Upsert transactions to DuckDB database using fingerprint-based deduplication.
+def publish_snapshot(con: duckdb.DuckDBPyConnection | None = None):
+    """Publishes a consistent copy of the database for readers.
 
-    Inserts new transactions and updates existing ones based on fingerprint.
+    Only one process can open a DuckDB file while it is written, so readers would have to
+    wait for long writes like a full import. Those writes therefore copy the database into a
+    temporary file which atomically replaces the snapshot, and readers open the snapshot
+    while the next long write runs, see reader_connection. The copy costs as much as reading
+    the whole database, so short writes like delta imports and watch batches only publish
+    the first snapshot, see publish_first_snapshot.
     """
-    db_path = get_db_path()
-    con = duckdb.connect(str(db_path))
+    snapshot_path = get_snapshot_path()
+    publishing_path = snapshot_path.with_name(snapshot_path.name + ".tmp")
+    publishing_path.unlink(missing_ok=True)
+
+    with db_connection(con) as con, profile_stage("publish_snapshot"):
+        source = con.execute("SELECT current_database()").fetchone()[0]
+        con.execute(f"ATTACH {sql_string(str(publishing_path))} AS snapshot")
+        try:
+            con.execute(f'COPY FROM DATABASE "{source}" TO snapshot')
+        except Exception:
+            con.execute("DETACH snapshot")
+            publishing_path.unlink(missing_ok=True)
+            raise
+        con.execute("DETACH snapshot")
+    os.replace(publishing_path, snapshot_path)
+
+
+def publish_first_snapshot(con: duckdb.DuckDBPyConnection | None = None):
+    """Publishes a snapshot after a short write if there is none of the current schema yet.
+
+    Readers wait for a writer only while there is no snapshot to read, see reader_connection.
+    """
+    if not PUBLISH_SNAPSHOT:
+        return
+    snapshot = open_snapshot()
+    if snapshot is None:
+        publish_snapshot(con)
+    else:
+        snapshot.close()
+
+
+TRANSACTION_COLUMNS = [
+    "account",
+    "book_date",
+    "valuta_date",
+    "party",
+    "book_text",
+    "purpose",
+    "amount_cents",
+    "balance_cents",
+    "transfer_category",
+    "category",
+    "category_manual",
+    "rule_hash",
+]
+
+# Effective category as computed by add_cat: the manual category unless it is blank.
+CAT_SQL = "COALESCE(NULLIF(trim(category_manual), ''), category)"
+
+
+# Columns with few distinct values, dictionary-encoded by to_compact_df
+CATEGORICAL_COLUMNS = [
+    "account",
+    "book_text",
+    "transfer_category",
+    "category",
+    "category_manual",
+    "rule_hash",
+    "cat",
+    "level1",
+    "level2",
+    "level3",
+]
+
+
+def to_compact_df(result: duckdb.DuckDBPyConnection) -> pd.DataFrame:
+    """Fetches a query result of transactions as a DataFrame with compact dtypes.
+
+    The CATEGORICAL_COLUMNS become pandas categoricals and dates become datetime64 instead of
+    Python objects. The result is fetched as an Arrow table, so no object columns are built,
+    and the remaining strings stay in Arrow memory (pd.ArrowDtype).
+    """
+    table = result.fetch_arrow_table()
+    for name in CATEGORICAL_COLUMNS:
+        if name in table.column_names:
+            index = table.schema.get_field_index(name)
+            table = table.set_column(index, name, table.column(name).dictionary_encode())
+
+    def types_mapper(arrow_type: pa.DataType) -> pd.ArrowDtype | None:
+        if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+            return pd.ArrowDtype(arrow_type)
+        return None
+
+    return table.to_pandas(types_mapper=types_mapper, date_as_object=False)
+
+
+def load_pc_from_db(
+    cents: bool = False,
+    start: str | date | None = None,
+    end: str | date | None = None,
+    accounts: list[str] | None = None,
+    category_prefixes: list[str] | None = None,
+    columns: list[str] | None = None,
+    order: bool = True,
+    compact: bool = False,
+    con: duckdb.DuckDBPyConnection | None = None,
+    reader: bool = False,
+) -> pd.DataFrame:
+    """Load transactions from DuckDB database.
 
-    try:
-        create_tables(con)
+    Converts amount_cents and balance_cents back to decimal for pandas compatibility, unless
+    cents is True. Then the integer cents columns are kept, see add_amounts.
+
+    The filters are evaluated by DuckDB, so only the requested slice is read:
+    start and end select book dates in [start, end), accounts restricts the accounts and
+    category_prefixes keeps rows whose effective category (see add_cat) starts with any of
+    the prefixes. columns selects a subset of the columns, where amount and balance may be
+    used for the cents columns. order=False skips sorting the result.
+
+    compact=True returns compact dtypes instead of object columns, see to_compact_df.
+
+    reader=True opens the database read-only, so that loading does not block imports and
+    falls back to the snapshot during long writes, see reader_connection.
+    """
+    if con is None and not get_db_path().exists():
+        return pd.DataFrame()
+
+    selected = [
+        {"amount": "amount_cents", "balance": "balance_cents"}.get(c, c)
+        for c in columns or TRANSACTION_COLUMNS
+    ]
+    unknown = set(selected) - set(TRANSACTION_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown columns: {sorted(unknown)}")
+
+    conditions = []
+    params: list = []
+    if start is not None:
+        conditions.append("book_date >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("book_date < ?")
+        params.append(end)
+    if accounts is not None:
+        conditions.append(
+            f"account IN ({', '.join('?' for _ in accounts)})" if accounts else "false"
+        )
+        params.extend(accounts)
+    if category_prefixes is not None:
+        prefix_conditions = [f"starts_with({CAT_SQL}, ?)" for _ in category_prefixes]
+        conditions.append(f"({' OR '.join(prefix_conditions) or 'false'})")
+        params.extend(category_prefixes)
+
+    query = f"SELECT {', '.join(selected)} FROM transactions"
+    if conditions:
+        query += f" WHERE {' AND '.join(conditions)}"
+    if order:
+        query += f" ORDER BY {TRANSACTION_ORDER}"
+
+    with db_connection(con, reader) as con, profile_stage("load") as record:
+        result = con.execute(query, params)
+        df = to_compact_df(result) if compact else result.df()
+        record["n_rows"] = df.shape[0]
+    if "amount_cents" in df.columns:
+        df["amount_cents"] = df["amount_cents"].astype("int64")
+    if "balance_cents" in df.columns:
+        df["balance_cents"] = df["balance_cents"].astype("Int64")
+
+    if cents:
+        return df
+
+    # Convert cents back to decimal amounts
+    df = add_amounts(df)
+
+    # Drop the cents columns (keep only decimal versions for pandas)
+    df = df.drop(columns=[c for c in ("amount_cents", "balance_cents") if c in df.columns])
+
+    return df
+
+
+def load_monthly_rollup(
+    start: str | date | None = None,
+    end: str | date | None = None,
+    accounts: list[str] | None = None,
+    category_prefixes: list[str] | None = None,
+    con: duckdb.DuckDBPyConnection | None = None,
+    reader: bool = False,
+) -> pd.DataFrame:
+    """Load the monthly sums of monthly_rollup, with compact dtypes.
+
+    start and end select the months in [start, end) and accounts restricts the accounts,
+    like in load_pc_from_db. category_prefixes keeps the subtrees of these categories, which
+    is a nested set lookup in categories instead of a string comparison per row.
+
+    cat is the effective category, see add_cat, and level1 to level3 are its ancestors at
+    each level, so that subtree totals are a groupby on one of them.
+    """
+    if con is None and not get_db_path().exists():
+        return pd.DataFrame()
+
+    conditions = ["true"]
+    params: list = []
+    if start is not None:
+        conditions.append("month >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("month < ?")
+        params.append(end)
+    if accounts is not None:
+        conditions.append(
+            f"account IN ({', '.join('?' for _ in accounts)})" if accounts else "false"
+        )
+        params.extend(accounts)
+    if category_prefixes is not None:
+        conditions.append(f"cat_id IN ({category_subtree_sql(category_prefixes)})")
+
+    levels = range(1, CATEGORY_LEVELS + 1)
+    level_columns = "".join(f", level{level}.path AS level{level}" for level in levels)
+    level_joins = "".join(
+        f" LEFT JOIN categories AS level{level} ON level{level}.category_id = c.level{level}_id"
+        for level in levels
+    )
+    with db_connection(con, reader) as con:
+        result = con.execute(
+            f"""
+            SELECT monthly_rollup.*{level_columns}
+            FROM monthly_rollup
+            LEFT JOIN categories AS c ON c.category_id = monthly_rollup.cat_id{level_joins}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY month, account, cat, transfer
+            """,
+            params,
+        )
+        return to_compact_df(result)
 
-        # Prepare dataframe for insertion
-        pc_insert = pc.copy()
 
-        # Convert amount and balance to cents (integers)
+def to_db_frame(pc: pd.DataFrame) -> pd.DataFrame:
+    """Returns a copy of pc with the columns of the transactions table, amounts in cents."""
+    pc_insert = pc.copy()
+
+    # Convert amount and balance to cents (integers), unless they already are
+    if "amount_cents" not in pc_insert.columns:
         pc_insert["amount_cents"] = (pc_insert["amount"] * 100).round().astype("Int64")
+    if "balance_cents" not in pc_insert.columns:
         pc_insert["balance_cents"] = (pc_insert["balance"] * 100).round().astype("Int64")
 
-        # Generate fingerprint for each row
-        pc_insert["fingerprint"] = pc_insert.apply(generate_fingerprint, axis=1)
+    for column in ("transfer_category", "category", "category_manual", "rule_hash"):
+        if column not in pc_insert.columns:
+            pc_insert[column] = None
 
-        # Get next available transaction_id
-        max_id_result = con.execute(
-            "SELECT COALESCE(MAX(transaction_id), 0) FROM transactions"
-        ).fetchone()
-        next_id = max_id_result[0] + 1 if max_id_result else 1
+    return pc_insert[
+        [
+            "account",
+            "book_date",
+            "valuta_date",
+            "party",
+            "book_text",
+            "purpose",
+            "amount_cents",
+            "balance_cents",
+            "transfer_category",
+            "category",
+            "category_manual",
+            "rule_hash",
+        ]
+    ]
 
-        # Assign transaction_ids (these will be used for new rows only)
-        pc_insert["transaction_id"] = range(next_id, next_id + len(pc_insert))
 
-        # Select columns for insertion
-        pc_insert = pc_insert[
-            [
-                "transaction_id",
-                "account",
-                "book_date",
-                "valuta_date",
-                "party",
-                "book_text",
-                "purpose",
-                "amount_cents",
-                "balance_cents",
-                "transfer_category",
-                "category",
-                "category_manual",
-                "fingerprint",
-            ]
-        ]
+def stage_for_db(con: duckdb.DuckDBPyConnection, pc: pd.DataFrame):
+    """Stage pc in the temp table staged, fingerprinted and with one row per fingerprint.
 
-        # Upsert using INSERT ON CONFLICT
+    The staged table has the column types of the transactions table.
+    """
+    with profile_stage("fingerprint", pc.shape[0]):
+        pc_insert = to_db_frame(pc)
         con.execute(
             """
-            INSERT INTO transactions (
-                transaction_id, account, book_date, valuta_date,
-                party, book_text, purpose, amount_cents, balance_cents,
-                transfer_category, category, category_manual, fingerprint
-            )
-            SELECT * FROM pc_insert
-            ON CONFLICT (fingerprint)
-            DO UPDATE SET
-                transfer_category = EXCLUDED.transfer_category,
-                category = EXCLUDED.category,
-                category_manual = EXCLUDED.category_manual,
-                balance_cents = EXCLUDED.balance_cents
+            CREATE OR REPLACE TEMP TABLE staged AS
+            SELECT * EXCLUDE (transaction_id, imported_at, party_id, book_text_id, purpose_id)
+            FROM transactions LIMIT 0
+        """
+        )
+        con.execute(
+            f"""
+            INSERT INTO staged BY NAME
+            SELECT DISTINCT ON (fingerprint) * FROM ({fingerprinted_sql("pc_insert")})
         """
         )
 
-        row_count = con.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
-        print(f"\nStored pandacount.duckdb with {row_count} rows in total")
-    finally:
-        con.close()
 
+def insert_staged(con: duckdb.DuckDBPyConnection) -> int:
+    """Insert the staged transactions whose fingerprint is not stored yet.
 
-def import_to_pandacount(pc: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
-    pc = pd.concat([pc, df], ignore_index=True)
-    pc.drop_duplicates(
-        subset=["account", "book_date", "valuta_date", "party", "book_text", "purpose", "amount"],
-        inplace=True,
-    )
-    pc.sort_values(
-        axis=0, by=["book_date", "account", "valuta_date", "party", "purpose"], inplace=True
+    The rows are appended in TRANSACTION_ORDER, with the ids of their values in the
+    dimension tables. Returns the number of inserted transactions.
+    """
+    row_count_before = con.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    sync_dimensions(con, "staged")
+    con.execute(
+        f"""
+        INSERT INTO transactions (
+            transaction_id, account, book_date, valuta_date,
+            party, book_text, purpose, amount_cents, balance_cents,
+            transfer_category, category, category_manual, fingerprint, rule_hash,
+            party_id, book_text_id, purpose_id
+        )
+        SELECT
+            (SELECT COALESCE(MAX(transaction_id), 0) FROM transactions)
+                + row_number() OVER (ORDER BY {TRANSACTION_ORDER}, fingerprint),
+            account, book_date, valuta_date,
+            party, book_text, purpose, amount_cents, balance_cents,
+            transfer_category, category, category_manual, fingerprint, rule_hash,
+            parties.id, book_texts.id, purposes.id
+        FROM staged
+        LEFT JOIN parties ON parties.value = party
+        LEFT JOIN book_texts ON book_texts.value = book_text
+        LEFT JOIN purposes ON purposes.value = purpose
+        ORDER BY {TRANSACTION_ORDER}, fingerprint
+        ON CONFLICT (fingerprint) DO NOTHING
+    """
     )
+    row_count = con.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    return row_count - row_count_before
+
+
+def save_pc_to_db(
+    pc: pd.DataFrame, con: duckdb.DuckDBPyConnection | None = None
+) -> tuple[int, int, int]:
+    """Upsert transactions to DuckDB database using fingerprint-based deduplication.
+
+    Inserts new transactions and updates existing ones based on fingerprint. Existing
+    transactions are only written if one of their updatable values changed.
+
+    Returns the number of inserted, updated and unchanged transactions.
+    """
+    db_path = get_db_path()
+    with db_connection(con) as con:
+        stage_for_db(con, pc)
+        months = changed_months(
+            con,
+            """
+            SELECT staged.book_date FROM staged
+            LEFT JOIN transactions USING (fingerprint)
+            WHERE transactions.fingerprint IS NULL
+                OR transactions.transfer_category IS DISTINCT FROM staged.transfer_category
+                OR transactions.category IS DISTINCT FROM staged.category
+                OR transactions.category_manual IS DISTINCT FROM staged.category_manual
+            """,
+        )
+
+        with profile_stage("upsert", pc.shape[0]):
+            updated = con.execute(
+                """
+                UPDATE transactions
+                SET
+                    transfer_category = staged.transfer_category,
+                    category = staged.category,
+                    category_manual = staged.category_manual,
+                    balance_cents = staged.balance_cents,
+                    rule_hash = staged.rule_hash
+                FROM staged
+                WHERE transactions.fingerprint = staged.fingerprint
+                    AND (
+                        transactions.transfer_category IS DISTINCT FROM staged.transfer_category
+                        OR transactions.category IS DISTINCT FROM staged.category
+                        OR transactions.category_manual IS DISTINCT FROM staged.category_manual
+                        OR transactions.balance_cents IS DISTINCT FROM staged.balance_cents
+                        OR transactions.rule_hash IS DISTINCT FROM staged.rule_hash
+                    )
+            """
+            ).fetchone()[0]
+            inserted = insert_staged(con)
+        with profile_stage("rollup"):
+            refresh_monthly_rollup(con, months)
+        unchanged = con.execute("SELECT COUNT(*) FROM staged").fetchone()[0] - inserted - updated
+
+        row_count = con.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        print(f"\nInserted {inserted}, updated {updated}, left {unchanged} rows unchanged")
+        print(f"Stored {db_path} with {row_count} rows in total")
+        return inserted, updated, unchanged
+
+
+def insert_new_to_db(df: pd.DataFrame, con: duckdb.DuckDBPyConnection | None = None) -> int:
+    """Insert only transactions whose fingerprint is not stored yet.
+
+    The rows are staged and fingerprinted in a DuckDB temp table and inserted with
+    ON CONFLICT DO NOTHING, so the cost depends on the size of df and not on the number of
+    stored transactions. Stored transactions are left untouched.
+
+    Returns the number of inserted transactions.
+    """
+    db_path = get_db_path()
+    with db_connection(con) as con:
+        stage_for_db(con, df)
+        months = changed_months(
+            con, "SELECT book_date FROM staged ANTI JOIN transactions USING (fingerprint)"
+        )
+        with profile_stage("upsert", df.shape[0]):
+            inserted = insert_staged(con)
+        with profile_stage("rollup"):
+            refresh_monthly_rollup(con, months)
+
+        row_count = con.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        print(f"\nInserted {inserted} new rows, {db_path} has {row_count} rows in total")
+        return inserted
+
+
+def new_rows(df: pd.DataFrame, con: duckdb.DuckDBPyConnection | None = None) -> pd.DataFrame:
+    """Returns the rows of df whose fingerprint is not stored yet."""
+    pc_rows = to_db_frame(df).assign(position=np.arange(df.shape[0]))
+    with db_connection(con) as con:
+        positions = con.execute(
+            f"""
+            SELECT position FROM ({fingerprinted_sql("pc_rows")})
+            ANTI JOIN transactions USING (fingerprint)
+            ORDER BY position
+            """
+        ).fetchnumpy()["position"]
+    return df.iloc[positions]
+
+
+def load_imported_files(
+    content_hashes: list[str], con: duckdb.DuckDBPyConnection | None = None
+) -> dict[str, tuple[str, datetime]]:
+    """Returns file name and import time of those content hashes that were imported before."""
+    if (con is None and not get_db_path().exists()) or not content_hashes:
+        return {}
+
+    with db_connection(con) as con:
+        rows = con.execute(
+            "SELECT content_hash, file_name, imported_at FROM imported_files"
+            f" WHERE content_hash IN ({', '.join('?' for _ in content_hashes)})",
+            content_hashes,
+        ).fetchall()
+        return {
+            content_hash: (file_name, imported_at) for content_hash, file_name, imported_at in rows
+        }
+
+
+def skip_imported(
+    content_hashes: dict[str, str], con: duckdb.DuckDBPyConnection | None = None
+) -> list[str]:
+    """Returns the files whose content was not imported before and reports the others."""
+    imported = load_imported_files(list(content_hashes.values()), con)
+    for file_name, content_hash in content_hashes.items():
+        if content_hash in imported:
+            imported_name, imported_at = imported[content_hash]
+            print(f"Skipping {file_name}, imported as {imported_name} on {imported_at:%Y-%m-%d}")
+    return [f for f, content_hash in content_hashes.items() if content_hash not in imported]
+
+
+def save_imported_files(
+    frames: dict[str, pd.DataFrame],
+    content_hashes: dict[str, str],
+    con: duckdb.DuckDBPyConnection | None = None,
+):
+    """Records the parsed frames of imported files with their content hashes."""
+    with db_connection(con) as con:
+        for file_name, df in frames.items():
+            pc_file = to_db_frame(df)
+            con.execute(
+                f"""
+                INSERT OR REPLACE INTO imported_files
+                    (content_hash, file_name, account, n_rows, min_fingerprint, max_fingerprint)
+                SELECT ?, ?, ?, count(*), min(fingerprint), max(fingerprint)
+                FROM ({fingerprinted_sql("pc_file")})
+                """,
+                [content_hashes[file_name], file_name, get_account(file_name)],
+            )
+
+
+def import_to_pandacount(pc: pd.DataFrame, *dfs: pd.DataFrame) -> pd.DataFrame:
+    """Merges any number of parsed dataframes into pc.
+
+    All dataframes are concatenated, deduplicated and sorted once, so importing many files
+    is a single pass instead of one merge per file.
+    """
+    with profile_stage("merge") as record:
+        pc = pd.concat([pc, *dfs], ignore_index=True)
+        record["n_rows"] = pc.shape[0]
+    with profile_stage("dedup", pc.shape[0]):
+        amount_column = "amount_cents" if "amount_cents" in pc.columns else "amount"
+        pc.drop_duplicates(
+            subset=["account", "book_date", "valuta_date", "party", "book_text", "purpose"]
+            + [amount_column],
+            inplace=True,
+        )
+        pc.sort_values(
+            axis=0,
+            by=["book_date", "account", "valuta_date", "party", "purpose"],
+            kind="stable",
+            inplace=True,
+        )
     return pc
 
 
-def categorize_pipeline(pc: pd.DataFrame) -> pd.DataFrame:
+def import_files(file_list: list[str], pc: pd.DataFrame | None = None) -> pd.DataFrame:
+    """Parses ING CSV files and merges them into pc in one batch.
+
+    Loads the stored transactions if pc is None. The result carries the amounts in cents and
+    is neither categorized nor saved, which makes this usable from notebooks and scripts, e.g.
+    add_amounts(import_files(glob.glob("downloads/Umsatzanzeige_*.csv"))).
+    """
+    if pc is None:
+        pc = load_pc_from_db(cents=True)
+    return import_to_pandacount(pc, parse_files(file_list))
+
+
+def categorize_pipeline(pc: pd.DataFrame, rule_stats: bool = False) -> pd.DataFrame:
+    """Categorizes pc. With rule_stats, the statistics of each rule are stored as well."""
     print(f"Categorizing {pc.shape[0]} entries...")
-    return pipe(pc, transfer_categorize, categorize_df)
+    if rule_stats:
+        save_rule_stats(rule_statistics(pc), n_rows=pc.shape[0])
+    with profile_stage("transfer_categorize", pc.shape[0]):
+        pc = transfer_categorize(pc)
+    with profile_stage("categorize_df", pc.shape[0]):
+        pc = categorize_df(pc)
+    return pc
 
 
-@app.command()
-def ing_import(file_list: list[str]):
-    """Import ING bank CSV files."""
-    pc = load_pc_from_db()
+def save_rule_stats(stats: pd.DataFrame, n_rows: int, con: duckdb.DuckDBPyConnection | None = None):
+    """Appends the result of rule_statistics for n_rows transactions to the rule_stats table."""
+    with db_connection(con) as con:
+        con.execute(
+            """
+            INSERT INTO rule_stats BY NAME
+            SELECT current_timestamp AS run_at, ? AS rule_hash, ? AS n_rows, * FROM stats
+            """,
+            [rule_set_hash(current_rule_set()), n_rows],
+        )
 
-    for file_name in file_list:
-        typer.echo(f"Processing {file_name}")
-        df = to_raw_df(file_name)
-        print(
-            f"  Importing dataframe with {df.shape[0]} rows (pandacount currently has {pc.shape[0]} rows)..."
+
+def print_rule_stats(stats: pd.DataFrame, top: int = 10):
+    """Lists the dead, shadowed, most matching and slowest rules."""
+    columns = ["kind", "category", "attribute", "account", "sub"]
+    sections = [
+        ("Dead rules, matching no transaction", stats[stats.matches == 0], columns),
+        (
+            "Shadowed rules, always overwritten by later rules",
+            stats[(stats.matches > 0) & (stats.wins == 0)],
+            [*columns, "matches"],
+        ),
+        (
+            f"Top {top} rules by matches",
+            stats.nlargest(top, "matches"),
+            [*columns, "matches", "overwrites", "wins"],
+        ),
+        (f"Top {top} rules by time", stats.nlargest(top, "seconds"), [*columns, "seconds"]),
+    ]
+    for title, rows, section_columns in sections:
+        print(f"\n{title} ({rows.shape[0]} of {stats.shape[0]}):")
+        if not rows.empty:
+            print(rows[section_columns].to_string(index=False))
+
+
+def load_rule_sets(con: duckdb.DuckDBPyConnection | None = None) -> dict[str, dict]:
+    """Load all rule sets that were ever used for categorization, keyed by their hash."""
+    if con is None and not get_db_path().exists():
+        return {}
+
+    with db_connection(con) as con:
+        rows = con.execute("SELECT rule_hash, rules FROM rule_sets").fetchall()
+        return {rule_hash: json.loads(rules) for rule_hash, rules in rows}
+
+
+def save_rule_set(rule_hash: str, rule_set: dict, con: duckdb.DuckDBPyConnection | None = None):
+    """Store a rule set so that later rule changes can be diffed against it."""
+    with db_connection(con) as con:
+        con.execute(
+            "INSERT INTO rule_sets (rule_hash, rules) VALUES (?, ?) ON CONFLICT DO NOTHING",
+            [rule_hash, json.dumps(rule_set)],
+        )
+
+
+def categorize_incremental(
+    pc: pd.DataFrame, con: duckdb.DuckDBPyConnection | None = None
+) -> pd.DataFrame:
+    """Categorizes only the rows that were not categorized by the current rule set.
+
+    New rows are always categorized. Rows categorized by an older, stored rule set are only
+    categorized again if one of the rules added or removed since then matches them.
+    """
+    rule_set = current_rule_set()
+    current_hash = rule_set_hash(rule_set)
+
+    if "rule_hash" not in pc.columns:
+        pc["rule_hash"] = None
+    stale = (pc["rule_hash"] != current_hash).to_numpy()
+    needs_categorization = stale & pc["rule_hash"].isna().to_numpy()
+
+    known_rule_sets = load_rule_sets(con)
+    for old_hash, rows in pc[stale].groupby("rule_hash"):
+        positions = pc.index.get_indexer(rows.index)
+        if old_hash in known_rule_sets:
+            needs_categorization[positions] = affected_by_rule_change(
+                rows, known_rule_sets[old_hash], rule_set
+            )
+        else:
+            needs_categorization[positions] = True
+
+    if needs_categorization.any():
+        categorized = categorize_pipeline(pc.loc[needs_categorization].copy())
+        for column in ("transfer_category", "category"):
+            pc.loc[needs_categorization, column] = categorized[column]
+    else:
+        print("All entries are categorized by the current rules.")
+
+    pc.loc[stale, "rule_hash"] = current_hash
+    save_rule_set(current_hash, rule_set, con)
+    return pc
+
+
+def categorize_db(con: duckdb.DuckDBPyConnection, full: bool = False) -> int:
+    """Categorizes the stored transactions inside DuckDB, see categorize_incremental.
+
+    The rules are matched against the distinct values by match_rules_db and applied in a
+    single UPDATE, so no DataFrame is loaded. With full, all rows are categorized. Returns
+    the number of categorized rows.
+    """
+    rule_set = current_rule_set()
+    current_hash = rule_set_hash(rule_set)
+
+    create_tables(con)
+    known_rule_sets = {
+        rule_hash: json.loads(rules)
+        for rule_hash, rules in con.execute("SELECT rule_hash, rules FROM rule_sets").fetchall()
+    }
+    if full:
+        stale, stale_params = "true", []
+    else:
+        stale, stale_params = "rule_hash IS DISTINCT FROM ?", [current_hash]
+    stale_hashes = con.execute(
+        f"SELECT DISTINCT rule_hash FROM transactions WHERE {stale}", stale_params
+    ).fetchall()
+
+    conditions = []
+    for (old_hash,) in stale_hashes:
+        if full or old_hash is None or old_hash not in known_rule_sets:
+            condition = "true"
+        else:
+            condition = affected_by_rule_change_sql(known_rule_sets[old_hash], rule_set)
+        if condition != "false":
+            hash_condition = "rule_hash IS NULL" if old_hash is None else "rule_hash = ?"
+            conditions.append((f"({hash_condition} AND {condition})", old_hash))
+    needs_categorization = " OR ".join(condition for condition, _ in conditions) or "false"
+    params = [old_hash for _, old_hash in conditions if old_hash is not None]
+    categorized = f"{stale} AND ({needs_categorization})"
+    categorized_params = [*stale_params, *params]
+
+    n_rows = con.execute(
+        f"SELECT count(*) FROM transactions WHERE {categorized}", categorized_params
+    ).fetchone()[0]
+    if n_rows:
+        print(f"Categorizing {n_rows} entries...")
+    else:
+        print("All entries are categorized by the current rules.")
+
+    assignments = categorize_sql()
+    con.execute("BEGIN TRANSACTION")
+    try:
+        if n_rows:
+            # A full run recomputes all months, see refresh_monthly_rollup
+            months = None
+            if not full:
+                months = changed_months(
+                    con,
+                    f"SELECT book_date FROM transactions WHERE {categorized}",
+                    categorized_params,
+                )
+            with profile_stage("categorize_db", n_rows):
+                match_rules_db(con, categorized, categorized_params)
+                con.execute(
+                    f"""
+                    UPDATE transactions SET
+                        transfer_category = {assignments["transfer_category"]},
+                        category = {assignments["category"]}
+                    FROM matched
+                    WHERE transaction_id = matched_id
+                    """
+                )
+            with profile_stage("rollup"):
+                refresh_monthly_rollup(con, months)
+        con.execute(
+            f"UPDATE transactions SET rule_hash = ? WHERE {stale}", [current_hash, *stale_params]
+        )
+        con.execute(
+            "INSERT INTO rule_sets (rule_hash, rules) VALUES (?, ?) ON CONFLICT DO NOTHING",
+            [current_hash, json.dumps(rule_set)],
         )
-        pc = import_to_pandacount(pc, df)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return n_rows
+
+
+@app.callback()
+def main(
+    profile: bool = typer.Option(
+        False, help="Report wall time, CPU time and peak RSS of each stage."
+    ),
+    profile_output: str | None = typer.Option(
+        None, help="Also append the stage profiles as JSON lines to this file."
+    ),
+    snapshot: bool = typer.Option(
+        True,
+        help="Publish pandacount.snapshot.duckdb for readers after long writes, and after short"
+        " ones while there is none.",
+    ),
+):
+    """Import and categorize ING bank statements into pandacount.duckdb."""
+    global PROFILE_STAGES, PROFILE_OUTPUT, PUBLISH_SNAPSHOT
+    PROFILE_STAGES = profile or profile_output is not None
+    PROFILE_OUTPUT = None if profile_output is None else Path(profile_output)
+    PUBLISH_SNAPSHOT = snapshot
+
+
+@app.command()
+def ing_import(file_list: list[str], delta: bool = False, force: bool = False):
+    """Import ING bank CSV files.
+
+    Files whose content was imported before are skipped, unless --force is given.
 
-    pc = categorize_pipeline(pc)
+    With --delta, the stored transactions are not loaded. Only the rows of the files that are
+    not stored yet are categorized and inserted, and a snapshot is only published if there is
+    none yet.
+    """
+    try:
+        content_hashes = {file_name: file_content_hash(file_name) for file_name in file_list}
+    except OSError as e:
+        typer.echo(str(e), err=True)
+        raise typer.Exit(code=1)
+
+    if not force:
+        file_list = skip_imported(content_hashes)
+        if not file_list:
+            print("All files were imported before.")
+            return
+
+    try:
+        with profile_stage("parse") as record:
+            frames = parse_file_frames(file_list)
+            df = pd.concat(list(frames.values()), ignore_index=True)
+            record["n_rows"] = df.shape[0]
+    except ValueError as e:
+        typer.echo(str(e), err=True)
+        raise typer.Exit(code=1)
+
+    if delta:
+        with db_connection() as con:
+            # Rows that are stored already are neither categorized nor staged again
+            df = new_rows(df, con)
+            if df.empty:
+                print("No new transactions.")
+            else:
+                df = categorize_incremental(df, con)
+                insert_new_to_db(df, con)
+            save_imported_files(frames, content_hashes, con)
+            publish_first_snapshot(con)
+        return
+
+    pc = load_pc_from_db(cents=True)
+    print(
+        f"Importing dataframe with {df.shape[0]} rows (pandacount currently has {pc.shape[0]} rows)..."
+    )
+    pc = import_to_pandacount(pc, df)
+
+    pc = categorize_incremental(pc)
     save_pc_to_db(pc)
+    save_imported_files(frames, content_hashes)
+    if PUBLISH_SNAPSHOT:
+        publish_snapshot()
+
+
+def import_new_statements(con: duckdb.DuckDBPyConnection, file_list: list[str]) -> int:
+    """Imports statement files over con, categorizing only the rows that are not stored yet.
+
+    Files that were imported before are skipped, and files that cannot be read or parsed
+    are reported and skipped. The files are parsed in this process, since batches are small.
+    The inserted rows and the ledger entries are written in one transaction.
+
+    Returns the number of inserted transactions.
+    """
+    content_hashes = {}
+    for file_name in file_list:
+        try:
+            content_hashes[file_name] = file_content_hash(file_name)
+        except OSError as e:
+            # E.g. renamed or moved away since the last poll
+            typer.echo(f"Failed to read {file_name}: {e}", err=True)
+    frames = {}
+    for file_name in skip_imported(content_hashes, con):
+        try:
+            frames[file_name] = to_raw_df(file_name)
+        except Exception as e:
+            typer.echo(f"Failed to parse {file_name}: {e}", err=True)
+        else:
+            typer.echo(f"Parsed {file_name} ({frames[file_name].shape[0]} rows)")
+    if not frames:
+        return 0
+
+    con.execute("BEGIN TRANSACTION")
+    try:
+        df = new_rows(pd.concat(list(frames.values()), ignore_index=True), con)
+        inserted = 0
+        if not df.empty:
+            df = categorize_incremental(df, con)
+            inserted = insert_new_to_db(df, con)
+        save_imported_files(frames, content_hashes, con)
+        con.execute("COMMIT")
+    except BaseException:
+        # Also on KeyboardInterrupt, so that the connection stays usable
+        con.execute("ROLLBACK")
+        raise
+    return inserted
+
+
+def raise_keyboard_interrupt(signum: int, frame):
+    """Signal handler that stops long running commands like Ctrl-C does."""
+    raise KeyboardInterrupt
+
+
+def statement_files(directory: Path) -> dict[Path, tuple[int, int]]:
+    """Returns size and modification time of the statement files in directory."""
+    files = {}
+    for path in directory.glob(STATEMENT_GLOB):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
 
 
 @app.command()
-def categorize():
-    """Re-categorize all transactions."""
-    pc = load_pc_from_db()
-    pc = categorize_pipeline(pc)
+def watch(directory: str, interval: float = 2.0, batch_size: int = 20):
+    """Import new ING statements as they appear in DIRECTORY, until interrupted.
+
+    DIRECTORY is polled every INTERVAL seconds for Umsatzanzeige_<IBAN>_*.csv files. A file is
+    imported once its size and modification time did not change between two polls, so that
+    downloads in progress are not read. Ready files are imported in batches of BATCH_SIZE
+    in one transaction. The database is only opened while a batch is written, so readers can
+    open it in between, and the first batch publishes a snapshot for them if there is none.
+    A batch that fails is reported and not retried until one of its files changes. SIGTERM
+    stops watching like Ctrl-C.
+    """
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+    print(f"Watching {directory} for {STATEMENT_GLOB}, press Ctrl-C to stop")
+
+    previous: dict[Path, tuple[int, int]] = {}
+    handled: dict[Path, tuple[int, int]] = {}
+    try:
+        while True:
+            files = statement_files(Path(directory))
+            ready = sorted(
+                path
+                for path, stat in files.items()
+                if previous.get(path) == stat and handled.get(path) != stat
+            )
+            while ready:
+                batch, ready = ready[:batch_size], ready[batch_size:]
+                handled.update((path, files[path]) for path in batch)
+                try:
+                    # Closing the connection also checkpoints the WAL into the database
+                    with db_connection() as con, profile_stage("import_batch"):
+                        import_new_statements(con, [str(path) for path in batch])
+                        publish_first_snapshot(con)
+                except Exception as e:
+                    typer.echo(f"Failed to import {len(batch)} files: {e}", err=True)
+            previous = files
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+
+
+@app.command()
+def categorize(full: bool = False, pandas: bool = False):
+    """Re-categorize transactions whose rules changed (all transactions with --full).
+
+    The rules run as SQL inside DuckDB. With --pandas, the transactions are loaded and
+    categorized with categorize_pipeline instead. Both --full and --pandas rewrite all
+    transactions, and then publish a snapshot. Other runs only publish the first snapshot.
+    """
+    if not pandas:
+        con = connect(get_db_path())
+        try:
+            categorize_db(con, full=full)
+            if not full:
+                publish_first_snapshot(con)
+            elif PUBLISH_SNAPSHOT:
+                publish_snapshot(con)
+        finally:
+            con.close()
+        return
+
+    pc = load_pc_from_db(cents=True)
+    if full:
+        pc["rule_hash"] = None
+    pc = categorize_incremental(pc)
     save_pc_to_db(pc)
+    if PUBLISH_SNAPSHOT:
+        publish_snapshot()
+
+
+def compact_db(db_path: Path) -> int:
+    """Rewrites the database with the transactions in TRANSACTION_ORDER.
+
+    Imports append rows, so files imported out of date order leave the table partly
+    unordered, and updates leave free blocks behind. Rewriting the table in place would keep
+    those blocks in the file, so all tables are copied into a fresh database file which then
+    replaces db_path. Returns the number of transactions.
+    """
+    compacted_path = db_path.with_name(db_path.name + ".compact")
+    compacted_path.unlink(missing_ok=True)
+
+    con = connect(db_path)
+    try:
+        create_tables(con)
+        source = con.execute("SELECT current_database()").fetchone()[0]
+        # create_tables already wrote the schema_version of the compacted database
+        tables = con.execute(
+            """
+            SELECT table_name FROM duckdb_tables()
+            WHERE database_name = ? AND NOT temporary AND table_name <> 'schema_version'
+            """,
+            [source],
+        ).fetchall()
+
+        con.execute(f"ATTACH {sql_string(str(compacted_path))} AS compacted")
+        con.execute("USE compacted")
+        create_tables(con)
+        for (table,) in tables:
+            order = f" ORDER BY {TRANSACTION_ORDER}" if table == "transactions" else ""
+            con.execute(f"INSERT INTO {table} BY NAME SELECT * FROM {source}.main.{table}{order}")
+        row_count = con.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        con.execute(f"USE {source}")
+        con.execute("DETACH compacted")
+    except Exception:
+        con.close()
+        compacted_path.unlink(missing_ok=True)
+        raise
+    con.close()
+
+    os.replace(compacted_path, db_path)
+    return row_count
+
+
+@app.command()
+def compact():
+    """Rewrite the transactions in date and account order and compact the database file."""
+    db_path = get_db_path()
+    if not db_path.exists():
+        print(f"{db_path} does not exist.")
+        return
+
+    size_before = db_path.stat().st_size
+    row_count = compact_db(db_path)
+    print(
+        f"Compacted {db_path} with {row_count} rows from {size_before / 2**20:.1f} MB"
+        f" to {db_path.stat().st_size / 2**20:.1f} MB"
+    )
+
+
+@app.command()
+def serve(host: str = "127.0.0.1", port: int = 8050, debug: bool = False):
+    """Serve the expense and income dashboard on HOST:PORT, see dashboard.py."""
+    if not get_db_path().exists():
+        print(f"{get_db_path()} does not exist, import statements first.")
+        raise typer.Exit(code=1)
+    # The dashboard only reads, so an older schema is brought up to date here
+    with db_connection():
+        pass
+
+    # Imported here, so that the other commands work without dash
+    from dashboard import create_app
+
+    create_app().run(host=host, port=port, debug=debug)
+
+
+@app.command()
+def rule_stats(top: int = 10):
+    """Profile every rule on all transactions and list dead and hot rules.
+
+    The statistics are stored in the rule_stats table, the categories are not changed.
+    """
+    pc = load_pc_from_db(
+        cents=True, columns=["account", "party", "book_text", "purpose", "amount_cents"]
+    )
+    if pc.empty:
+        print("No transactions.")
+        return
+    stats = rule_statistics(pc)
+    save_rule_stats(stats, n_rows=pc.shape[0])
+    print_rule_stats(stats, top)
 
 
 if __name__ == "__main__":
@@ -10,27 +10,42 @@ def _():
     import datetime
     import pandas as pd
     import matplotlib.pyplot as plt
-    from panda import load_pc_from_db, add_cat
+    from panda import load_pc_from_db, load_monthly_rollup, add_amounts, add_cat
+
+    def load_pc(**filters) -> pd.DataFrame:
+        """Laedt nur den benoetigten Ausschnitt, die Filter (start, end, accounts,
+        category_prefixes, columns) werden in DuckDB ausgewertet.
+
+        Betraege werden in Cent geladen, damit Summen exakt sind; amount nur fuer die Anzeige.
+        Konten, Buchungstexte und Kategorien kommen als category-Spalten (compact=True).
+        Gelesen wird nur lesend (reader=True); waehrend ein Import schreibt, wird der
+        zuletzt veroeffentlichte Snapshot gelesen.
+        """
+        return add_cat(
+            add_amounts(load_pc_from_db(cents=True, compact=True, reader=True, **filters))
+        )
+
+    pc_2024 = load_pc(start="2024-01-01", end="2025-01-01")
 
-    pc = load_pc_from_db()
-    pc = add_cat(pc)
-    return datetime, pc, pd, plt
+    # Monatssummen je Konto, Kategorie und Transfer-Flag (monthly_rollup) fuer die Uebersichten
+    rollup_2024 = load_monthly_rollup(start="2024-01-01", end="2025-01-01", reader=True)
+    return datetime, load_pc, pc_2024, pd, plt, rollup_2024
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Display column information
     print("Columns in dataset:")
-    print(pc.columns)
+    print(pc_2024.columns)
     return
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Finden von nicht-kategorisierten Abbuchungen auf den Konten 'giro', 'gesa' und 'common' im Jahr 2024
 
     # Kopie des DataFrames erstellen
-    df = pc.loc[(pc.book_date.dt.year == 2024) & (pc.transfer_category.isna())]
+    df = pc_2024.loc[(pc_2024.book_date.dt.year == 2024) & (pc_2024.transfer_category.isna())]
     df = df.copy()
 
     # 'amount_type' setzen basierend auf dem Betrag
@@ -80,11 +95,11 @@ def _(plt, uncategorized_transactions):
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Gesamteinnahmen 2024
-    income_df = pc.loc[
-        (pc.book_date.dt.year == 2024) &
-        (pc['cat'].isin(['einnahmen::gehalt::andreas', 'einnahmen::gehalt::gesa', 'einnahmen::dividende']))
+    income_df = pc_2024.loc[
+        (pc_2024.book_date.dt.year == 2024) &
+        (pc_2024['cat'].isin(['einnahmen::gehalt::andreas', 'einnahmen::gehalt::gesa', 'einnahmen::dividende']))
         ]
     return (income_df,)
 
@@ -100,14 +115,14 @@ def _(income_df):
 def _(pd):
     # Einkommensuebersicht 2024
     def generate_income_overview(income_df: pd.DataFrame) -> pd.DataFrame:
-        # Sum by category
-        category_sum = income_df.groupby('cat')['amount'].sum()
+        # Sum by category (exact in cents)
+        category_sum = income_df.groupby('cat', observed=True)['amount_cents'].sum() / 100
 
         # Overall sum
-        overall_sum = income_df['amount'].sum()
+        overall_sum = income_df['amount_cents'].sum() / 100
 
         # Combine results into a DataFrame
-        overview_df = category_sum.reset_index().rename(columns={'amount': 'category_sum'})
+        overview_df = category_sum.reset_index().rename(columns={'amount_cents': 'category_sum'})
         overview_df.loc[len(overview_df)] = ['Overall Sum', overall_sum]
 
         return overview_df
@@ -115,25 +130,28 @@ def _(pd):
 
 
 @app.cell
-def _(generate_income_overview, income_df):
-    # Generate the income overview
-    income_overview_df = generate_income_overview(income_df)
+def _(generate_income_overview, rollup_2024):
+    # Generate the income overview from the monthly sums
+    income_rollup = rollup_2024.loc[
+        rollup_2024['cat'].isin(['einnahmen::gehalt::andreas', 'einnahmen::gehalt::gesa', 'einnahmen::dividende'])
+    ]
+    income_overview_df = generate_income_overview(income_rollup)
     income_overview_df
     return
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Filter für alle Ausgaben im Jahr 2024
-    expenses_df = pc.loc[
-        (pc.book_date.dt.year == 2024) &  # Nur Buchungen aus dem Jahr 2024
-        (~pc['cat'].str.startswith('intern', na=False)) &  # "intern"-Kategorie ausschließen
-        (~pc['cat'].str.startswith('einnahmen', na=False)) &  # "einnahmen"-Kategorie ausschließen
-        (pc['transfer_category'].isna()) &  # transfer_category muss NaN sein
-        (pc['account'].isin(['giro', 'common', 'gesa']))  # Nur bestimmte Konten berücksichtigen
+    expenses_df = pc_2024.loc[
+        (pc_2024.book_date.dt.year == 2024) &  # Nur Buchungen aus dem Jahr 2024
+        (~pc_2024['cat'].str.startswith('intern', na=False)) &  # "intern"-Kategorie ausschließen
+        (~pc_2024['cat'].str.startswith('einnahmen', na=False)) &  # "einnahmen"-Kategorie ausschließen
+        (pc_2024['transfer_category'].isna()) &  # transfer_category muss NaN sein
+        (pc_2024['account'].isin(['giro', 'common', 'gesa']))  # Nur bestimmte Konten berücksichtigen
         ]
 
-    print(f"Total expenses amount: {expenses_df['amount'].sum()}")
+    print(f"Total expenses amount: {expenses_df['amount_cents'].sum() / 100}")
     return (expenses_df,)
 
 
@@ -150,19 +168,19 @@ def _(pd):
     def generate_expense_overview(expenses_df: pd.DataFrame) -> pd.DataFrame:
         # Replace NaN in 'cat' with 'Uncategorized'
         expenses_df = expenses_df.copy()
-        expenses_df['cat'] = expenses_df['cat'].fillna('Uncategorized')
+        expenses_df['cat'] = expenses_df['cat'].cat.add_categories('Uncategorized').fillna('Uncategorized')
 
-        # Sum by category and account
-        category_account_sum = expenses_df.groupby(['cat', 'account'])['amount'].sum().unstack(fill_value=0)
+        # Sum by category and account (exact in cents)
+        category_account_sum = expenses_df.groupby(['cat', 'account'], observed=True)['amount_cents'].sum().unstack(fill_value=0) / 100
 
         # Sum by category across all accounts
-        category_sum = expenses_df.groupby('cat')['amount'].sum()
+        category_sum = expenses_df.groupby('cat', observed=True)['amount_cents'].sum() / 100
 
         # Overall sum across all accounts
-        overall_sum = expenses_df['amount'].sum()
+        overall_sum = expenses_df['amount_cents'].sum() / 100
 
         # Combine results into a DataFrame
-        overview_df = category_sum.reset_index().rename(columns={'amount': 'category_sum'})
+        overview_df = category_sum.reset_index().rename(columns={'amount_cents': 'category_sum'})
         overview_df['giro'] = overview_df['cat'].map(category_account_sum.get('giro', {}))
         overview_df['gesa'] = overview_df['cat'].map(category_account_sum.get('gesa', {}))
         overview_df['common'] = overview_df['cat'].map(category_account_sum.get('common', {}))
@@ -183,25 +201,30 @@ def _(pd):
 
 
 @app.cell
-def _(expenses_df, generate_expense_overview):
-    # Generate the expense overview
-    expense_overview_df = generate_expense_overview(expenses_df)
+def _(generate_expense_overview, rollup_2024):
+    # Generate the expense overview from the monthly sums, filtered like expenses_df
+    expenses_rollup = rollup_2024.loc[
+        (~rollup_2024['level1'].isin(['intern', 'einnahmen'])) &  # Teilbaeume ueber die Kategorie-Ebene
+        (~rollup_2024['transfer']) &
+        (rollup_2024['account'].isin(['giro', 'common', 'gesa']))
+        ]
+    expense_overview_df = generate_expense_overview(expenses_rollup)
     expense_overview_df
     return
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Giro account positive amounts for 2024
-    giro_positive_2024 = pc[(pc.account == "giro") & (pc.amount > 0) & (pc.book_date.dt.year == 2024)]
+    giro_positive_2024 = pc_2024[(pc_2024.account == "giro") & (pc_2024.amount > 0) & (pc_2024.book_date.dt.year == 2024)]
     giro_positive_2024
     return
 
 
 @app.cell
-def _(pc):
+def _(load_pc):
     # Anwaltskosten (Legal costs)
-    df_legal = pc
+    df_legal = load_pc()
     legal_costs_1 = df_legal[
         df_legal['party'].str.contains('KNH|zirngibl', case=False, na=False) |
         df_legal['purpose'].str.contains('KNH|zirngibl', case=False, na=False)
@@ -224,75 +247,77 @@ def _(df_legal):
 
 
 @app.cell
-def _(datetime, pc):
+def _(datetime, load_pc):
     # Alle wohnen::putzen Ausgaben für das Jahr 2023 (All cleaning expenses for 2023)
-    df_2023 = pc[(pc.account == 'common') &
-                 (pc.book_date > datetime.datetime(2023, 2, 1, 0, 0, 0)) &
-                 (pc.book_date < datetime.datetime(2024, 2, 1, 0, 0, 0))]
+    _pc = load_pc(start="2023-02-01", end="2024-02-01", accounts=['common'])
+    df_2023 = _pc[(_pc.account == 'common') &
+                  (_pc.book_date > datetime.datetime(2023, 2, 1, 0, 0, 0)) &
+                  (_pc.book_date < datetime.datetime(2024, 2, 1, 0, 0, 0))]
     cleaning_2023 = df_2023[df_2023['cat'] == 'wohnen::putzen']
     cleaning_2023
     return
 
 
 @app.cell
-def _(datetime, pc):
+def _(datetime, load_pc):
     # Alle wohnen::putzen Ausgaben für das Jahr 2024 (All cleaning expenses for 2024)
-    df_2024 = pc[(pc.account == 'common') &
-                 (pc.book_date > datetime.datetime(2024, 2, 1, 0, 0, 0)) &
-                 (pc.book_date < datetime.datetime(2025, 2, 1, 0, 0, 0))]
+    _pc = load_pc(start="2024-02-01", end="2025-02-01", accounts=['common'])
+    df_2024 = _pc[(_pc.account == 'common') &
+                  (_pc.book_date > datetime.datetime(2024, 2, 1, 0, 0, 0)) &
+                  (_pc.book_date < datetime.datetime(2025, 2, 1, 0, 0, 0))]
     cleaning_2024 = df_2024[df_2024['cat'] == 'wohnen::putzen']
     cleaning_2024
     return
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Arbeitszimmer 2024: Darlehenszinsen (Home office 2024: Loan interest)
-    loan_payments_2024 = pc[
-        (pc.book_date.dt.year == 2024) &
-        (pc.account == 'common') &
-        (pc.purpose.str.contains('Tilgung', case=False, na=False)) &
-        pc.purpose.str.contains('Leistung')
+    loan_payments_2024 = pc_2024[
+        (pc_2024.book_date.dt.year == 2024) &
+        (pc_2024.account == 'common') &
+        (pc_2024.purpose.str.contains('Tilgung', case=False, na=False)) &
+        pc_2024.purpose.str.contains('Leistung')
     ]
     loan_payments_2024
     return
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Arbeitszimmer 2024: Stromkosten (Home office 2024: Electricity costs)
-    naturstrom_2024 = pc[pc.party.str.contains('Naturstrom', case=False, na=False) & (pc.book_date.dt.year == 2024)]
-    electricity_total = naturstrom_2024.amount.sum()
+    naturstrom_2024 = pc_2024[pc_2024.party.str.contains('Naturstrom', case=False, na=False) & (pc_2024.book_date.dt.year == 2024)]
+    electricity_total = naturstrom_2024.amount_cents.sum() / 100
     print(f"Total electricity costs 2024: {electricity_total}")
     return
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Arbeitszimmer 2024: Hausgeld (Home office 2024: Housing fees)
-    wohngeld = pc[(pc.cat=='wohnen::wohngeld') & (pc.book_date.dt.year == 2024)]
-    housing_fees_total = wohngeld.amount.sum()
+    wohngeld = pc_2024[(pc_2024.cat=='wohnen::wohngeld') & (pc_2024.book_date.dt.year == 2024)]
+    housing_fees_total = wohngeld.amount_cents.sum() / 100
     print(f"Total housing fees 2024: {housing_fees_total}")
     return
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Arbeitszimmer 2024: Grundsteuer (Home office 2024: Property tax)
-    grundsteuer = pc[(pc.book_date.dt.year == 2024) &
-                     (pc.amount < 0) &
-                     (pc.purpose.str.contains('Grundst', case=False, na=False))]
-    property_tax_total = grundsteuer.amount.sum()
+    grundsteuer = pc_2024[(pc_2024.book_date.dt.year == 2024) &
+                          (pc_2024.amount < 0) &
+                          (pc_2024.purpose.str.contains('Grundst', case=False, na=False))]
+    property_tax_total = grundsteuer.amount_cents.sum() / 100
     print(f"Total property tax 2024: {property_tax_total}")
     return
 
 
 @app.cell
-def _(pc):
+def _(pc_2024):
     # Arbeitszimmer 2024: Telefon Mobil (Home office 2024: Mobile phone)
     # Internet ist auf kontist, und deswegen hier nicht sichtbar
-    congstar = pc[(pc.book_date.dt.year == 2024) & (pc.purpose.str.contains('2212684943'))]
-    mobile_phone_total = congstar.amount.sum()
+    congstar = pc_2024[(pc_2024.book_date.dt.year == 2024) & (pc_2024.purpose.str.contains('2212684943'))]
+    mobile_phone_total = congstar.amount_cents.sum() / 100
     print(f"Total mobile phone costs 2024: {mobile_phone_total}")
     return
 
@@ -337,9 +362,10 @@ def _():
 
 
 @app.cell
-def _(az_kontist_internet, pc, pd):
+def _(az_kontist_internet, load_pc, pd):
     # Laufende Kosten 2025 aus pandacount (volles Jahr)
-    _y = pc.book_date.dt.year == 2025
+    _pc = load_pc(start="2025-01-01", end="2026-01-01")
+    _y = _pc.book_date.dt.year == 2025
 
     def _euro(series: pd.Series) -> pd.Series:
         """Deutsche Beträge '1.234,56' in float umwandeln."""
@@ -351,28 +377,28 @@ def _(az_kontist_internet, pc, pd):
 
     # Darlehenszinsen: Zinsanteil aus dem Verwendungszweck extrahieren
     # ("Rechnung Darl.-Leistung ... Tilgung 898,22 Zinsen 140,12").
-    _loan = pc[_y & (pc.account == "common") & pc.purpose.str.contains("Darl.-Leistung", na=False)]
-    az_darlehenszinsen = _euro(_loan.purpose.str.extract(r"Zinsen\s+([\d.]+,\d{2})")[0]).sum()
+    _loan = _pc[_y & (_pc.account == "common") & _pc.purpose.str.contains("Darl.-Leistung", na=False)]
+    az_darlehenszinsen = _euro(_loan.purpose.str.extract(r"Zinsen\s+(?P<zinsen>[\d.]+,\d{2})")["zinsen"]).sum()
 
     # Stromkosten (Naturstrom), netto inkl. Jahresabrechnungs-Gutschrift.
-    az_strom = -pc[_y & pc.party.str.contains("Naturstrom", case=False, na=False)].amount.sum()
+    az_strom = -_pc[_y & _pc.party.str.contains("Naturstrom", case=False, na=False)].amount_cents.sum() / 100
 
     # Hausgeld (inkl. HGA-Gutschrift).
-    az_hausgeld = -pc[_y & (pc.cat == "wohnen::wohngeld")].amount.sum()
+    az_hausgeld = -_pc[_y & (_pc.cat == "wohnen::wohngeld")].amount_cents.sum() / 100
 
     # Grundsteuer (4 Quartalsraten).
-    az_grundsteuer = -pc[
-        _y & (pc.amount < 0) & pc.purpose.str.contains("Grundst", case=False, na=False)
-    ].amount.sum()
+    az_grundsteuer = -_pc[
+        _y & (_pc.amount_cents < 0) & _pc.purpose.str.contains("Grundst", case=False, na=False)
+    ].amount_cents.sum() / 100
 
     # Internet (1&1 ab Mai in pandacount + Kontist Jan-Apr manuell).
     az_internet = -(
-        pc[_y & pc.party.str.contains(r"1\+1 Telecom", case=False, na=False, regex=True)].amount.sum()
+        _pc[_y & _pc.party.str.contains(r"1\+1 Telecom", case=False, na=False, regex=True)].amount_cents.sum() / 100
         + sum(az_kontist_internet)
     )
 
     # Telefon mobil (fraenk, ab April 2025).
-    az_telefon = -pc[_y & pc.party.str.contains("fraenk", case=False, na=False)].amount.sum()
+    az_telefon = -_pc[_y & _pc.party.str.contains("fraenk", case=False, na=False)].amount_cents.sum() / 100
     return (
         az_darlehenszinsen,
         az_grundsteuer,